@@ -0,0 +1,153 @@
+import argparse
+import json
+import shutil
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+from panda3d.core import (
+    Filename,
+    NodePath,
+    SamplerState,
+    Texture,
+    loadPrcFileData,
+)
+
+
+def compress_textures(model):
+    # Pre-generate mipmaps and DXT-compress real textures so the driver does
+    # not have to at load time. The 1x1 PBR fallbacks are left alone.
+    for texture in model.findAllTextures():
+        if texture.getXSize() < 8 or not texture.hasRamImage():
+            continue
+        texture.setMinfilter(SamplerState.FT_linear_mipmap_linear)
+        texture.generateRamMipmapImages()
+        mode = Texture.CM_dxt5 if texture.getNumComponents() == 4 else Texture.CM_dxt1
+        texture.compressRamImage(mode, Texture.QL_best, None)
+
+
+def bake_model(main, app, bake, path, actor, force):
+    target = bake.path("model", ".bam", path)
+    if target.exists() and not force:
+        return target, False
+    model = app.loader.loadModel(path, noCache=True)
+    main.strip_exported_lights(model)
+    if not actor:
+        # Animated models need their joint hierarchy; static ones collapse
+        # into as few nodes and Geoms as possible.
+        model.clearModelNodes()
+        model.flattenStrong()
+    compress_textures(model)
+    write_atomic(target, lambda tmp: model.writeBamFile(Filename.fromOsSpecific(str(tmp))))
+    model.remove_node()
+    return target, True
+
+
+def bake_heightmap(main, bake, path, chunk_size, force):
+    outputs = []
+    target = bake.path("heights", ".npy", path)
+    if force or not target.exists():
+        heights = main.Heightfield.decode(path)
+        write_atomic(target, lambda tmp: np.save(tmp, heights, allow_pickle=False))
+        outputs.append((target, True))
+    else:
+        outputs.append((target, False))
+
+    target = bake.path(f"heightfield{chunk_size}", "", path)
+    if force or not target.exists():
+        pager = main.TerrainPager("terrain", path, NodePath("focus"), chunk_size=chunk_size)
+        tmp = target.with_name(target.name + ".tmp")
+        shutil.rmtree(tmp, ignore_errors=True)
+        tmp.mkdir(parents=True)
+        for cy in range(pager.chunks_y):
+            for cx in range(pager.chunks_x):
+                pager.chunk_heightfield(cx, cy).write(
+                    Filename.fromOsSpecific(str(tmp / pager.chunk_file(cx, cy)))
+                )
+        shutil.rmtree(target, ignore_errors=True)
+        tmp.rename(target)
+        outputs.append((target, True))
+    else:
+        outputs.append((target, False))
+    return outputs
+
+
+def bake_atlas(app, bake, force):
+    # The App was started without a bake cache, so its atlas was packed
+    # from the source images.
+    atlas = app.hud_atlas
+    texture_target = bake.path(atlas.kind, ".txo", *atlas.paths)
+    uv_target = bake.path(atlas.kind, ".json", *atlas.paths)
+    if texture_target.exists() and uv_target.exists() and not force:
+        return [(texture_target, False), (uv_target, False)]
+    texture = atlas.texture
+    texture.setMinfilter(SamplerState.FT_linear_mipmap_linear)
+    texture.generateRamMipmapImages()
+    write_atomic(uv_target, lambda tmp: tmp.write_text(json.dumps(atlas.uvs)))
+    write_atomic(texture_target, lambda tmp: texture.write(Filename.fromOsSpecific(str(tmp))))
+    return [(texture_target, True), (uv_target, True)]
+
+
+def write_atomic(target, write):
+    # Readers only test for existence, so never leave a half-written file.
+    target.parent.mkdir(parents=True, exist_ok=True)
+    tmp = target.with_name(f"{target.stem}.tmp{target.suffix}")
+    write(tmp)
+    tmp.replace(target)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bake Martian Madness assets.")
+    parser.add_argument("--cache", default="bake-cache", help="output directory")
+    parser.add_argument("--force", action="store_true", help="rebake everything")
+    parser.add_argument(
+        "--prune", action="store_true", help="delete artifacts of old source files"
+    )
+    args = parser.parse_args()
+
+    loadPrcFileData(
+        "",
+        "window-type none\n"
+        "audio-library-name null\n"
+        # Embed texture images in the baked .bam files.
+        "bam-texture-mode rawdata\n",
+    )
+    import main as game
+
+    app = game.App(bake_dir=None)
+    bake = game.BakeCache(args.cache)
+    levels = (game.Level1, game.Level2)
+
+    assets = [level.assets() for level in levels]
+    heightmaps = {game.LevelFile.load(level.level_file).heightmap for level in levels}
+
+    outputs = []
+    start = time.perf_counter()
+    for paths, actor in (
+        (sorted({p for models, _actors, _sounds in assets for p in models}), False),
+        (sorted({p for _models, actors, _sounds in assets for p in actors}), True),
+    ):
+        for path in paths:
+            outputs.append(bake_model(game, app, bake, path, actor, args.force))
+    for heightmap in sorted(heightmaps):
+        outputs.extend(bake_heightmap(game, bake, heightmap, 128, args.force))
+    outputs.extend(bake_atlas(app, bake, args.force))
+
+    for target, built in outputs:
+        print(f"{'baked' if built else 'fresh'} {target}")
+    if args.prune:
+        keep = {target.name for target, _built in outputs}
+        for stale in Path(args.cache).iterdir():
+            if stale.name not in keep:
+                print(f"pruned {stale}")
+                if stale.is_dir():
+                    shutil.rmtree(stale)
+                else:
+                    stale.unlink()
+    print(f"{len(outputs)} artifacts in {time.perf_counter() - start:.2f}s", file=sys.stderr)
+    app.destroy()
+
+
+if __name__ == "__main__":
+    main()
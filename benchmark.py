@@ -0,0 +1,288 @@
+import argparse
+import json
+import math
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from panda3d.core import (
+    ClockObject,
+    KeyboardButton,
+    MouseButton,
+    PNMImage,
+    loadPrcFileData,
+)
+
+
+class ScriptedInput:
+    # Stands in for base.mouseWatcherNode so the level tasks read scripted
+    # input through their usual code paths.
+    def __init__(self, scenario):
+        self.scenario = scenario
+        self.frame = 0
+        self.buttons = set()
+        self.mouse = (0.0, 0.0)
+
+    def advance(self):
+        self.buttons, self.mouse = self.scenario(self.frame)
+        self.frame += 1
+
+    def hasMouse(self):
+        return True
+
+    def getMouseX(self):
+        return self.mouse[0]
+
+    def getMouseY(self):
+        return self.mouse[1]
+
+    def is_button_down(self, button):
+        return button in self.buttons
+
+
+def idle(_frame):
+    return set(), (0.0, 0.0)
+
+
+def patrol(frame):
+    # Walk forward while sweeping the view, firing in bursts.
+    buttons = {KeyboardButton.ascii_key("w")}
+    if frame // 60 % 2:
+        buttons.add(MouseButton.one())
+    if frame % 240 == 0:
+        buttons.add(KeyboardButton.space())
+    return buttons, (0.02 * math.sin(frame / 50), -0.005 * math.cos(frame / 70))
+
+
+def turret(frame):
+    # Stand still, spin and keep the trigger held.
+    return {MouseButton.one()}, (0.03, 0.0)
+
+
+SCENARIOS = {"idle": idle, "patrol": patrol, "turret": turret}
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    k = (len(sorted_values) - 1) * pct / 100
+    lo = math.floor(k)
+    hi = min(lo + 1, len(sorted_values) - 1)
+    return sorted_values[lo] + (sorted_values[hi] - sorted_values[lo]) * (k - lo)
+
+
+def make_heightmap(size, seed, workdir):
+    path = (workdir / f"heightmap_{size}_{seed}.png").as_posix()
+    image = PNMImage(size, size, 1)
+    image.perlinNoiseFill(4.0 / size, 4.0 / size, 256, seed)
+    image.write(path)
+    return path
+
+
+def make_level_file(path, args, workdir):
+    with open(path) as f:
+        data = json.load(f)
+    aliens = data["aliens"]
+    if args.aliens is not None:
+        aliens["groups"] = [dict(aliens["groups"][0], count=args.aliens)]
+    if args.fire_interval is not None:
+        aliens["fire_interval"] = args.fire_interval
+    if args.terrain_size is not None:
+        data["heightmap"] = make_heightmap(args.terrain_size, args.seed, workdir)
+    if args.spawn_radius is not None:
+        data.setdefault("streaming", {})["radius"] = args.spawn_radius
+    path = (workdir / Path(path).name).as_posix()
+    with open(path, "w") as f:
+        json.dump(data, f)
+    return path
+
+
+def run(args):
+    # The generated level file and heightmap only live as long as the run.
+    with tempfile.TemporaryDirectory(prefix="martian_") as workdir:
+        return run_level(args, Path(workdir))
+
+
+def run_level(args, workdir):
+    loadPrcFileData(
+        "",
+        f"window-type {args.window}\n"
+        "audio-library-name null\n"
+        "sync-video false\n"
+        "notify-level-device fatal\n",
+    )
+    import main
+
+    random.seed(args.seed)
+    if args.replay:
+        args.level = main.InputReplay(args.replay).level
+    level_class = getattr(main, args.level)
+    level_class.level_file = make_level_file(level_class.level_file, args, workdir)
+
+    app = main.App(
+        timings_path=args.record_timings, record_path=args.record, replay_path=args.replay
+    )
+    system_samples = {}
+
+    def sample(_frame, _frame_ms, systems):
+        if measuring:
+            for name, ms in systems.items():
+                system_samples.setdefault(name, []).append(ms)
+
+    measuring = False
+    app.timings.listeners.append(sample)
+    clock = ClockObject.getGlobalClock()
+    clock.setMode(ClockObject.MNonRealTime)
+    clock.setFrameRate(args.fps)
+    scripted = ScriptedInput(SCENARIOS[args.scenario])
+    app.mouseWatcherNode = scripted
+
+    load_start = time.perf_counter()
+    app.fsm.request(args.level)
+    load_time = time.perf_counter() - load_start
+    level = getattr(app.fsm, args.level.lower())
+    if args.invulnerable:
+        level.player.take_damage = lambda damage: None
+    level.sim.speed = args.speed
+    steps_per_frame = max(1, round(args.speed))
+
+    frame_times = []
+    for frame in range(args.warmup + args.frames):
+        measuring = frame >= args.warmup
+        scripted.advance()
+        start = time.perf_counter()
+        if args.no_render:
+            level.sim.run(steps_per_frame)
+        else:
+            app.taskMgr.step()
+        if frame >= args.warmup:
+            frame_times.append((time.perf_counter() - start) * 1000)
+        if app.fsm.state != args.level:
+            break
+        if app.replay and app.replay.finished:
+            break
+
+    tasks = {}
+    for task in app.taskMgr.getAllTasks():
+        tasks[task.name] = {
+            "average_ms": task.getAverageDt() * 1000,
+            "max_ms": task.getMaxDt() * 1000,
+        }
+
+    systems = {}
+    for name, samples in system_samples.items():
+        samples.sort()
+        systems[name] = {
+            "mean_ms": sum(samples) / len(samples),
+            "p95_ms": percentile(samples, 95),
+            "max_ms": samples[-1],
+        }
+
+    ordered = sorted(frame_times)
+    report = {
+        "scenario": {
+            "level": args.level,
+            "scenario": args.scenario,
+            "frames": len(frame_times),
+            "warmup": args.warmup,
+            "fps": args.fps,
+            "aliens": level.num_aliens,
+            "fire_interval": level.layout.fire_interval,
+            "terrain_size": level.terrain.size_x,
+            "window": args.window,
+            "seed": args.seed,
+            "speed": args.speed,
+            "no_render": args.no_render,
+        },
+        "sim": {"steps": level.sim.steps, "time": level.sim.time},
+        "load_ms": load_time * 1000,
+        "frame_ms": {
+            "mean": sum(ordered) / len(ordered) if ordered else 0.0,
+            "p50": percentile(ordered, 50),
+            "p90": percentile(ordered, 90),
+            "p95": percentile(ordered, 95),
+            "p99": percentile(ordered, 99),
+            "max": ordered[-1] if ordered else 0.0,
+        },
+        "collision_ms": systems.get("Collisions", {}),
+        "systems": systems,
+        "tasks": tasks,
+        "projectiles": level.projectiles.pressure(),
+        "audio": level.voices.pressure(),
+        "animation": level.animation.counts(),
+        "cells": level.cells.counts(),
+        "spawner": level.spawner.counts(),
+        "scheduler": app.scheduler.report(),
+        "final_state": app.fsm.state,
+    }
+    if app.replay:
+        report["replay"] = {
+            "steps": app.replay.steps,
+            "checksums": app.replay.checked,
+            "diverged_at": app.replay.diverged_at,
+        }
+    app.fsm.request("MainMenu")
+    app.destroy()
+    return report
+
+
+def compare(report, baseline, tolerance):
+    regressions = []
+    for key in ("mean", "p50", "p95", "p99"):
+        old = baseline["frame_ms"].get(key)
+        new = report["frame_ms"][key]
+        if old and new > old * (1 + tolerance):
+            regressions.append(f"frame_ms.{key}: {old:.3f} -> {new:.3f}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark a Martian Madness level.")
+    parser.add_argument("--level", default="Level1", choices=["Level1", "Level2"])
+    parser.add_argument("--scenario", default="patrol", choices=sorted(SCENARIOS))
+    parser.add_argument("--frames", type=int, default=600)
+    parser.add_argument("--warmup", type=int, default=60)
+    parser.add_argument("--fps", type=float, default=60)
+    parser.add_argument("--aliens", type=int)
+    parser.add_argument("--fire-interval", type=float)
+    parser.add_argument("--terrain-size", type=int, help="e.g. 257, 1025")
+    parser.add_argument("--spawn-radius", type=float, help="alien region streaming radius")
+    parser.add_argument("--window", default="offscreen", choices=["offscreen", "none"])
+    parser.add_argument("--speed", type=float, default=1, help="simulation fast-forward")
+    parser.add_argument(
+        "--no-render", action="store_true", help="step the simulation only, no frames"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--invulnerable", action="store_true")
+    parser.add_argument("--record", metavar="FILE", help="record the scripted input")
+    parser.add_argument("--replay", metavar="FILE", help="drive the level from a recording")
+    parser.add_argument("--output", help="write the JSON report here")
+    parser.add_argument("--record-timings", metavar="CSV", help="per-frame system timings")
+    parser.add_argument("--baseline", help="compare against this JSON report")
+    parser.add_argument("--save-baseline", help="also write the report here")
+    parser.add_argument("--tolerance", type=float, default=0.1)
+    args = parser.parse_args()
+
+    report = run(args)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+    else:
+        print(text)
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            f.write(text)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        for line in regressions:
+            print(f"regression: {line}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
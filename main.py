@@ -1,15 +1,28 @@
-import datetime
+import argparse
+import csv
+import gzip
+import hashlib
+import heapq
+import json
 import math
+import os
 import sys
 import random
+import struct
+import time
+import zlib
 from pathlib import Path
 
+import numpy as np
+
 from direct.actor.Actor import Actor
+from direct.directnotify.DirectNotifyGlobal import directNotify
 from direct.fsm.FSM import FSM
 from direct.gui import DirectGuiGlobals
 from direct.gui.DirectButton import DirectButton
 from direct.gui.OnscreenImage import OnscreenImage
 from direct.gui.OnscreenText import OnscreenText
+from direct.showbase.MessengerGlobal import messenger
 from direct.showbase.ShowBase import ShowBase
 from direct.showbase.ShowBaseGlobal import globalClock
 from direct.task import Task
@@ -18,6 +31,8 @@ from direct.task import Task
 from panda3d.core import *
 
 loadPrcFileData("", "win-size 1200 720")
+# Streamed sounds keep this much decoded audio queued ahead of playback.
+loadPrcFileData("", "audio-buffering-seconds 1")
 
 ground_mask = BitMask32.bit(1)
 wall_mask = BitMask32.bit(2)
@@ -29,23 +44,736 @@ atmosphere_col = 0.7529, 0.6196, 0.3921
 
 
 class App(ShowBase):
-    def __init__(self):
+    def __init__(
+        self,
+        timings_path=None,
+        timing_overlay=False,
+        record_path=None,
+        replay_path=None,
+        bake_dir="bake-cache",
+    ):
         super().__init__()
         props = WindowProperties()
         props.set_title("Martian Madness")
         props.icon_filename = "assets/logo.ico"
-        self.win.requestProperties(props)
-        self.music = self.loader.loadSfx("assets/sfx/music.wav")
+        self.request_properties(props)
+        self.music = self.musicManager.getSound(
+            Filename("assets/sfx/music.wav"), False, AudioManager.SM_stream
+        )
         self.music.setVolume(0.5)
         self.music.setLoop(True)
         self.music.play()
         self.set_background_color(*atmosphere_col)
-        fsm = AppStateFSM(self)
-        fsm.request("MainMenu")
+        self.timings = SystemTimer(self)
+        self.timing_overlay = TimingOverlay(self, visible=timing_overlay)
+        self.timing_recorder = None
+        if timings_path:
+            self.timing_recorder = TimingRecorder(self.timings, timings_path)
+        self.accept("f3", self.timing_overlay.toggle)
+        self.scheduler = FrameScheduler(self)
+        self.record_path = record_path
+        self.record_sessions = 0
+        self.replay = InputReplay(replay_path) if replay_path else None
+        self.bake = BakeCache(bake_dir) if bake_dir else None
+        self.assets = AssetCache(self.loader, self.bake)
+        self.hud_atlas = TextureAtlas(
+            [
+                "assets/alien.png",
+                "assets/textures/cross.png",
+                "assets/textures/enemy.png",
+                "assets/textures/minimap.png",
+                "assets/textures/playerhead.png",
+                "assets/textures/rover.png",
+            ],
+            bake=self.bake,
+        )
+        self.task_mgr.setupTaskChain("loading", numThreads=1)
+        self.fsm = AppStateFSM(self)
+        self.fsm.request("MainMenu")
+
+    def destroy(self):
+        # Quitting mid-level ends up here; leaving the level's state suspends
+        # it, which closes its input recording.
+        self.fsm.cleanup()
+        self.fsm.drop_warm()
+        if self.timing_recorder:
+            self.timing_recorder.close()
+        self.scheduler.destroy()
+        super().destroy()
+
+    def has_window(self):
+        return isinstance(self.win, GraphicsWindow)
+
+    def request_properties(self, props):
+        if self.has_window():
+            self.win.requestProperties(props)
+
+    def next_record_path(self):
+        # A replay holds one level session, so each start gets its own file:
+        # the first uses the given name, later ones add -2, -3, ...
+        self.record_sessions += 1
+        if self.record_sessions == 1:
+            return self.record_path
+        path = Path(self.record_path)
+        return str(path.with_name(f"{path.stem}-{self.record_sessions}{path.suffix}"))
+
+
+class SystemTimer:
+    engine_tasks = ("collisionLoop", "igLoop")
+
+    def __init__(self, base):
+        self.base = base
+        self.collectors = {}
+        self.frame = {}
+        self.listeners = []
+        base.task_mgr.add(self.flush_task, "system_timer_flush", sort=100)
+
+    def wrap(self, name, func):
+        if name not in self.collectors:
+            self.collectors[name] = PStatCollector(f"Systems:{name}")
+        collector = self.collectors[name]
+
+        def timed(*args, **kwargs):
+            collector.start()
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                collector.stop()
+                elapsed = (time.perf_counter() - start) * 1000
+                self.frame[name] = self.frame.get(name, 0) + elapsed
+
+        return timed
+
+    def flush_task(self, task):
+        for name in self.engine_tasks:
+            engine_task = self.base.task_mgr.mgr.findTask(name)
+            if engine_task:
+                self.frame[name] = engine_task.getDt() * 1000
+        frame = globalClock.getFrameCount()
+        frame_ms = globalClock.getDt() * 1000
+        for listener in self.listeners:
+            listener(frame, frame_ms, self.frame)
+        self.frame = {}
+        return task.cont
+
+
+class TimingRecorder:
+    def __init__(self, timings, path):
+        self.timings = timings
+        self.file = open(path, "w", newline="")
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(["frame", "frame_ms", "system", "ms"])
+        timings.listeners.append(self.record)
+
+    def record(self, frame, frame_ms, systems):
+        self.writer.writerows(
+            (frame, f"{frame_ms:.3f}", name, f"{ms:.3f}") for name, ms in systems.items()
+        )
+        if frame % 60 == 0:
+            self.file.flush()
+
+    def close(self):
+        if self.file.closed:
+            return
+        self.timings.listeners.remove(self.record)
+        self.file.close()
+
+
+class TimingOverlay:
+    def __init__(self, base, visible=False, interval=0.25):
+        self.base = base
+        self.interval = interval
+        self.totals = {}
+        self.frames = 0
+        self.last_update = 0
+        self.text = OnscreenText(
+            "",
+            parent=base.a2dTopRight,
+            pos=(-0.05, -0.35),
+            scale=0.045,
+            align=TextNode.ARight,
+            fg=(1, 1, 1, 1),
+            shadow=(0, 0, 0, 1),
+            mayChange=True,
+        )
+        self.visible = not visible
+        self.toggle()
+        base.timings.listeners.append(self.record)
+
+    def toggle(self):
+        self.visible = not self.visible
+        if self.visible:
+            self.text.show()
+        else:
+            self.text.hide()
+
+    def record(self, _frame, frame_ms, systems):
+        if not self.visible:
+            return
+        self.frames += 1
+        self.totals["frame"] = self.totals.get("frame", 0) + frame_ms
+        for name, ms in systems.items():
+            self.totals[name] = self.totals.get(name, 0) + ms
+        now = globalClock.getRealTime()
+        if now - self.last_update < self.interval:
+            return
+        lines = [
+            f"{name}: {total / self.frames:.2f} ms"
+            for name, total in sorted(self.totals.items(), key=lambda item: -item[1])
+        ]
+        self.text.setText("\n".join(lines))
+        self.totals = {}
+        self.frames = 0
+        self.last_update = now
+
+
+class ScheduledSystem:
+    __slots__ = (
+        "scheduler",
+        "name",
+        "func",
+        "priority",
+        "interval",
+        "due",
+        "runs",
+        "deferred",
+        "total_ms",
+        "max_ms",
+    )
+
+    def __init__(self, scheduler, name, func, priority, interval, due):
+        self.scheduler = scheduler
+        self.name = name
+        self.func = func
+        self.priority = priority
+        self.interval = interval
+        self.due = due
+        self.runs = 0
+        self.deferred = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def remove(self):
+        self.scheduler.remove(self)
+
+
+class FrameScheduler:
+    # Runs deferrable systems (minimap, HUD, terrain LOD, ...) from one task.
+    # Each is registered once with a priority and a target rate. Every frame
+    # the due systems run in priority order until budget_ms is spent; the
+    # rest wait for a later frame, but never by more than one extra period.
+    # Frames whose systems went over the budget are counted as overruns.
+    def __init__(self, base, budget_ms=2.0):
+        self.base = base
+        self.budget_ms = budget_ms
+        self.systems = []
+        self.frames = 0
+        self.overruns = 0
+        self.task = base.task_mgr.add(self.update_task, "frame_scheduler", sort=40)
+
+    def add(self, name, func, priority=0, rate=None):
+        # rate=None runs every frame and is never deferred, since it has no
+        # period to fall behind by. Returns the handle that removes it again.
+        system = ScheduledSystem(
+            self,
+            name,
+            self.base.timings.wrap(name, func),
+            priority,
+            1 / rate if rate else 0.0,
+            globalClock.getFrameTime(),
+        )
+        self.systems.append(system)
+        self.systems.sort(key=lambda s: s.priority)
+        return system
+
+    def remove(self, system):
+        if system in self.systems:
+            self.systems.remove(system)
+
+    def update_task(self, task):
+        now = globalClock.getFrameTime()
+        spent = 0.0
+        for system in list(self.systems):
+            if system.due > now:
+                continue
+            if spent >= self.budget_ms and now - system.due < system.interval:
+                system.deferred += 1
+                continue
+            start = time.perf_counter()
+            system.func()
+            elapsed = (time.perf_counter() - start) * 1000
+            spent += elapsed
+            system.runs += 1
+            system.total_ms += elapsed
+            system.max_ms = max(system.max_ms, elapsed)
+            system.due = max(system.due + system.interval, now)
+        self.frames += 1
+        if spent > self.budget_ms:
+            self.overruns += 1
+        return task.cont
+
+    def report(self):
+        return {
+            "budget_ms": self.budget_ms,
+            "frames": self.frames,
+            "overruns": self.overruns,
+            "systems": {
+                s.name: {
+                    "runs": s.runs,
+                    "deferred": s.deferred,
+                    "mean_ms": s.total_ms / s.runs if s.runs else 0.0,
+                    "max_ms": s.max_ms,
+                }
+                for s in self.systems
+            },
+        }
+
+    def destroy(self):
+        self.task.remove()
+        self.systems.clear()
+
+
+class BakeCache:
+    # Artifacts written by bake.py, named by a hash of their source files so
+    # a stale bake is never picked up.
+    version = 2
+
+    def __init__(self, root):
+        self.root = Path(root)
+        self.digests = {}
+
+    def digest(self, *sources):
+        combined = hashlib.sha1(f"v{self.version}".encode())
+        for source in sources:
+            stat = os.stat(source)
+            key = (str(source), stat.st_mtime_ns, stat.st_size)
+            if key not in self.digests:
+                self.digests[key] = hashlib.sha1(Path(source).read_bytes()).hexdigest()
+            combined.update(self.digests[key].encode())
+        return combined.hexdigest()
+
+    def path(self, kind, suffix, *sources):
+        return self.root / f"{self.digest(*sources)}.{kind}{suffix}"
+
+    def find(self, kind, suffix, *sources):
+        path = self.path(kind, suffix, *sources)
+        return path.as_posix() if path.exists() else None
+
+
+def strip_exported_lights(model):
+    # Some models were exported with Blender's camera and lamp. The lamp is
+    # set on an ancestor, and that LightAttrib holds a path back down to it,
+    # a cycle that keeps the whole model alive after it is released. The
+    # level has its own lights anyway.
+    for node in [model] + list(model.findAllMatches("**")):
+        node.clearLight()
+    for node in model.findAllMatches("**/+Camera") + model.findAllMatches("**/+LightNode"):
+        node.remove_node()
+    return model
+
+
+class AssetCache:
+    def __init__(self, loader, bake=None):
+        self.loader = loader
+        self.bake = bake
+        self.prototypes = {}
+        self.refs = {}
+        self.sounds = {}
+        self.resolved = {}
+
+    def resolve(self, path):
+        if path not in self.resolved:
+            baked = self.bake and self.bake.find("model", ".bam", path)
+            self.resolved[path] = baked or path
+        return self.resolved[path]
+
+    def preload(self, models, actors, sounds, callback):
+        # Loads anything not already resident on the async loader thread and
+        # calls callback(path) as each one arrives. Animated models are the
+        # exception: reading one there while frames render corrupted the heap
+        # in about one soak run in ten, so those load here and now.
+        def loaded(model, path):
+            if path not in self.prototypes:
+                self.prototypes[path] = strip_exported_lights(model)
+            callback(path)
+
+        def loaded_sound(sound, path):
+            self.sounds.setdefault(path, sound)
+            callback(path)
+
+        for path in actors:
+            if path not in self.prototypes:
+                self.prototypes[path] = self.load_prototype(path, actor=True)
+            callback(path)
+        requests = []
+        for path in models:
+            if path in self.prototypes:
+                callback(path)
+                continue
+            requests.append(
+                self.loader.load_model(
+                    self.resolve(path), noCache=True, callback=loaded, extraArgs=[path]
+                )
+            )
+        for path in sounds:
+            if path in self.sounds:
+                callback(path)
+                continue
+            requests.append(
+                self.loader.loadSfx(path, callback=loaded_sound, extraArgs=[path])
+            )
+        return requests
+
+    def load_prototype(self, path, actor):
+        # This is the pool, so bypass Panda's ModelPool rather than keep a
+        # second copy of every model there.
+        model = self.loader.load_model(self.resolve(path), noCache=True)
+        strip_exported_lights(model)
+        return Actor(model) if actor else model
+
+    def acquire(self, path, actor=False):
+        if path not in self.prototypes:
+            self.prototypes[path] = self.load_prototype(path, actor)
+        self.refs[path] = self.refs.get(path, 0) + 1
+        return self.prototypes[path]
+
+    def load_model(self, path):
+        return self.acquire(path).copyTo(NodePath())
+
+    def load_actor(self, path):
+        return Actor(other=self.acquire(path, actor=True))
+
+    def acquire_sound(self, path):
+        # Nothing plays the cached sound itself; holding it keeps its sample
+        # resident in the audio manager, which hands the same sample to any
+        # other sound made from the file instead of decoding it again.
+        if path not in self.sounds:
+            self.sounds[path] = self.loader.loadSfx(path)
+        self.refs[path] = self.refs.get(path, 0) + 1
+        return self.sounds[path]
+
+    def release(self, path):
+        self.refs[path] -= 1
+        if self.refs[path] > 0:
+            return
+        del self.refs[path]
+        if path in self.sounds:
+            del self.sounds[path]
+            return
+        prototype = self.prototypes.pop(path)
+        if isinstance(prototype, Actor):
+            prototype.cleanup()
+        prototype.remove_node()
+        del self.resolved[path]
+
+
+class SoundPool:
+    # Each category owns a fixed set of voices sharing one cached sample, so
+    # overlapping sounds no longer restart each other. A full category steals
+    # its quietest, oldest voice unless the new sound would be quieter still.
+    # The level keeps the samples resident through AssetCache.
+    def __init__(self, manager, listener, max_distance=40):
+        self.manager = manager
+        self.listener = listener
+        self.max_distance = max_distance
+        self.categories = {}
+        self.serial = 0
+        self.played = 0
+        self.stolen = 0
+        self.dropped = 0
+        self.culled = 0
+
+    def add_category(self, name, path, voices, volume=1.0, play_rate=1.0):
+        sounds = []
+        for _ in range(voices):
+            sound = self.manager.getSound(Filename(path), False, AudioManager.SM_sample)
+            sound.setPlayRate(play_rate)
+            sounds.append([sound, 0, 0.0])
+        self.categories[name] = (sounds, volume)
+
+    def play(self, name, pos=None):
+        sounds, volume = self.categories[name]
+        if pos is not None:
+            dist = (Point3(*pos) - self.listener.get_pos()).length()
+            if dist > self.max_distance:
+                self.culled += 1
+                return
+            volume *= 1 - dist / self.max_distance
+        voice = min(
+            sounds, key=lambda v: (v[0].status() == AudioSound.PLAYING, v[2], v[1])
+        )
+        if voice[0].status() == AudioSound.PLAYING:
+            if voice[2] > volume:
+                self.dropped += 1
+                return
+            voice[0].stop()
+            self.stolen += 1
+        self.serial += 1
+        voice[1:] = self.serial, volume
+        voice[0].setVolume(volume)
+        voice[0].play()
+        self.played += 1
+
+    def stop(self):
+        for sounds, _volume in self.categories.values():
+            for voice in sounds:
+                voice[0].stop()
+
+    def pressure(self):
+        return {
+            "voices": {name: len(c[0]) for name, c in self.categories.items()},
+            "played": self.played,
+            "stolen": self.stolen,
+            "dropped": self.dropped,
+            "culled": self.culled,
+        }
+
+    def destroy(self):
+        self.stop()
+        self.categories.clear()
+
+
+class Simulation:
+    # Gameplay advances in fixed steps; rendering interpolates between the
+    # last two steps. speed > 1 runs several steps per rendered frame and
+    # run() advances with no rendering at all.
+    def __init__(self, base, rate=60, max_steps=8):
+        self.base = base
+        self.dt = 1 / rate
+        self.max_steps = max_steps
+        self.speed = 1
+        self.time = 0.0
+        self.steps = 0
+        self.accumulator = 0.0
+        self.systems = []
+        self.renderers = []
+        self.interpolated = {}
+        self.timers = []
+        self.timer_seq = 0
+        self.running = False
+        self.task = None
+
+    def start(self):
+        self.running = True
+        self.accumulator = 0.0
+        self.task = self.base.task_mgr.add(self.update_task, "simulation_task")
+
+    def stop(self):
+        self.running = False
+        if self.task:
+            self.task.remove()
+            self.task = None
+
+    def snapshot(self):
+        return self.time, self.steps, list(self.timers)
+
+    def restore(self, state):
+        self.time, self.steps, timers = state
+        self.timers = list(timers)
+        self.accumulator = 0.0
+        for node in self.interpolated:
+            self.interpolate(node)
+
+    def add_system(self, name, func):
+        self.systems.append(self.base.timings.wrap(name, func))
+
+    def add_renderer(self, func):
+        self.renderers.append(func)
+
+    def interpolate(self, node):
+        pos = node.get_pos()
+        self.interpolated[node] = [pos, pos, pos]
+
+    def call_later(self, delay, func):
+        self.timer_seq += 1
+        heapq.heappush(self.timers, (self.time + delay, self.timer_seq, func))
+
+    def step(self):
+        for func in self.systems:
+            if not self.running:
+                # A system ended the level, e.g. the player died.
+                return
+            func(self.dt)
+        self.time += self.dt
+        self.steps += 1
+        while self.timers and self.timers[0][0] <= self.time:
+            heapq.heappop(self.timers)[2]()
+
+    def run(self, steps):
+        for _ in range(steps):
+            self.step()
+
+    def update_task(self, task):
+        for node, (_prev, curr, shown) in self.interpolated.items():
+            # Keep anything that moved the node since the last frame, such as
+            # a collision push or a teleport.
+            node.set_pos(curr + (node.get_pos() - shown))
+
+        self.accumulator += globalClock.getDt() * self.speed
+        budget = self.max_steps * max(1, math.ceil(self.speed))
+        steps = 0
+        while self.running and self.accumulator >= self.dt and steps < budget:
+            for node, state in self.interpolated.items():
+                state[0] = node.get_pos()
+            self.step()
+            for node, state in self.interpolated.items():
+                state[1] = node.get_pos()
+            self.accumulator -= self.dt
+            steps += 1
+        if steps == budget:
+            # Too slow to keep up; drop the backlog rather than spiral.
+            self.accumulator = min(self.accumulator, self.dt)
+
+        alpha = self.accumulator / self.dt
+        for node, state in self.interpolated.items():
+            prev, curr, _shown = state
+            state[2] = prev + (curr - prev) * alpha
+            node.set_fluid_pos(state[2])
+        for func in self.renderers:
+            func(alpha)
+        return task.cont
+
+    def destroy(self):
+        self.stop()
+        self.systems.clear()
+        self.renderers.clear()
+        self.interpolated.clear()
+        self.timers.clear()
+
+
+class PlayerInput:
+    # Input is sampled once per simulation step so a session can be recorded
+    # and replayed step for step. Mouse look accumulates between steps and is
+    # only previewed by the camera until the next step commits it.
+    buttons = (
+        ("forward", KeyboardButton.ascii_key("w")),
+        ("back", KeyboardButton.ascii_key("s")),
+        ("right", KeyboardButton.ascii_key("d")),
+        ("left", KeyboardButton.ascii_key("a")),
+        ("jump", KeyboardButton.space()),
+        ("fire", MouseButton.one()),
+    )
+    bits = {name: 1 << i for i, (name, _button) in enumerate(buttons)}
+
+    def __init__(self, base, recorder=None, replay=None):
+        self.base = base
+        self.recorder = recorder
+        self.replay = replay
+        self.state = 0
+        self.look = (0.0, 0.0)
+        self.pending = [0.0, 0.0]
+
+    def add_look(self, dh, dv):
+        self.pending[0] += dh
+        self.pending[1] += dv
+
+    def sample(self):
+        if self.replay:
+            step = self.replay.read_step()
+            if step is None:
+                self.state, self.look = 0, (0.0, 0.0)
+                return False
+            self.state, self.look = step
+            return True
+        watcher = self.base.mouseWatcherNode
+        self.state = 0
+        if watcher:
+            for name, button in self.buttons:
+                if watcher.is_button_down(button):
+                    self.state |= self.bits[name]
+        # Round the look through float32 so live play and replay agree exactly.
+        self.look = struct.unpack("<2f", struct.pack("<2f", *self.pending))
+        self.pending = [0.0, 0.0]
+        if self.recorder:
+            self.recorder.write_step(self.state, self.look)
+        return True
+
+    def down(self, name):
+        return bool(self.state & self.bits[name])
+
+
+class InputRecorder:
+    magic = b"MMRP"
+    version = 1
+    look_bit = 0x80
+    checksum_marker = 0x40
+
+    def __init__(self, path, level, seed):
+        self.file = gzip.open(path, "wb")
+        name = level.encode()
+        self.file.write(struct.pack("<4sHB", self.magic, self.version, len(name)))
+        self.file.write(name)
+        self.file.write(struct.pack("<Q", seed))
+
+    def write_step(self, state, look):
+        if look == (0.0, 0.0):
+            self.file.write(struct.pack("<B", state))
+        else:
+            self.file.write(struct.pack("<B2f", state | self.look_bit, *look))
+
+    def write_checksum(self, checksum):
+        self.file.write(struct.pack("<BI", self.checksum_marker, checksum))
+        # Flushed at each checksum so a crash keeps all but the last second.
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class InputReplay:
+    notify = directNotify.newCategory("InputReplay")
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            # A session that crashed leaves no gzip trailer; decompressing
+            # by hand keeps everything up to its last flush.
+            self.data = zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(f.read())
+        magic, version, name_len = struct.unpack_from("<4sHB", self.data)
+        if magic != InputRecorder.magic or version != InputRecorder.version:
+            raise ValueError(f"{path} is not a version {InputRecorder.version} replay")
+        offset = struct.calcsize("<4sHB")
+        self.level = self.data[offset : offset + name_len].decode()
+        (self.seed,) = struct.unpack_from("<Q", self.data, offset + name_len)
+        self.start = offset + name_len + 8
+        self.rewind()
+
+    def rewind(self):
+        self.offset = self.start
+        self.steps = 0
+        self.checked = 0
+        self.diverged_at = None
+        self.finished = False
+
+    def read_step(self):
+        if self.offset >= len(self.data):
+            self.finished = True
+            return None
+        state = self.data[self.offset]
+        if state & InputRecorder.look_bit:
+            look = struct.unpack_from("<2f", self.data, self.offset + 1)
+            self.offset += 9
+        else:
+            look = (0.0, 0.0)
+            self.offset += 1
+        self.steps += 1
+        return state & ~InputRecorder.look_bit, look
+
+    def check(self, checksum):
+        if self.offset >= len(self.data):
+            return
+        if self.data[self.offset] != InputRecorder.checksum_marker:
+            raise ValueError(f"replay out of sync at step {self.steps}")
+        (expected,) = struct.unpack_from("<I", self.data, self.offset + 1)
+        self.offset += 5
+        self.checked += 1
+        if expected != checksum and self.diverged_at is None:
+            self.diverged_at = self.steps
+            self.notify.warning(f"replay diverged at step {self.steps}")
 
 
 class Player:
-    def __init__(self, node, cTrav, base, fsm):
+    def __init__(self, node, cTrav, base, fsm, actor):
         self.node = node
         self.node.setTag("player", "1")
         self.base = base
@@ -58,7 +786,7 @@ class Player:
         self.rot_h = self.rot_v = 0
         self.grounded = True
 
-        self.actor = Actor("assets/models/player.bam")
+        self.actor = actor
         self.actor.reparent_to(self.node)
         # self.actor.loop("Idle")
 
@@ -81,31 +809,13 @@ class Player:
         # self.lifter.addCollider(lift_col_node, self.node)
         # cTrav.addCollider(lift_col_node, self.lifter)
 
-        gun_ray_node = CollisionNode("gun_ray_node")
-        gun_ray_node_path = self.camera.attachNewNode(gun_ray_node)
-        gun_ray = CollisionRay(0, 1, 1, 0, 1, 0)
-        gun_ray_node.addSolid(gun_ray)
-        gun_ray_node.setFromCollideMask(enemy_mask | ground_mask | wall_mask)
-        gun_ray_node.setIntoCollideMask(0)
-        self.gun_queue = CollisionHandlerQueue()
-        cTrav.addCollider(gun_ray_node_path, self.gun_queue)
-
-        vehicle_pointer_ray_node = CollisionNode("vehicle_pointer_ray_node")
-        vehicle_pointer_ray_node_path = self.camera.attachNewNode(
-            vehicle_pointer_ray_node
-        )
-        rover_pointer_ray = CollisionRay(0, 1, 1, 0, 1, 0)
-        vehicle_pointer_ray_node.addSolid(rover_pointer_ray)
-        vehicle_pointer_ray_node.setFromCollideMask(rover_mask | spaceship_mask)
-        vehicle_pointer_ray_node.setIntoCollideMask(0)
-        handler = CollisionHandlerEvent()
-        handler.addInPattern("vehicle_enter")
-        handler.addOutPattern("vehicle_exit")
-        cTrav.addCollider(vehicle_pointer_ray_node_path, handler)
 
         self.node.set_scale(self.node, 0.1)
         self.node.set_pos(-8, -8, 1)
 
+        self.capsule_radius = 0.06
+        self.capsule_height = 0.19
+
         self.hp = 100
         self.hp_bar = HealthBar()
         self.hp_bar.reparent_to(self.base.aspect2d)
@@ -119,84 +829,1111 @@ class Player:
             self.fsm.request("DeadScreen")
 
 
+class Heightfield:
+    def __init__(self, path, scale_z, bake=None):
+        baked = bake and bake.find("heights", ".npy", path)
+        if baked:
+            self.heights = np.load(baked) * np.float32(scale_z)
+        else:
+            self.heights = self.decode(path) * np.float32(scale_z)
+        self.size_y, self.size_x = self.heights.shape
+
+    @staticmethod
+    def decode(path):
+        img = PNMImage(Filename(path))
+        tex = Texture()
+        tex.load(img)
+        dtype = np.uint16 if tex.getComponentWidth() == 2 else np.uint8
+        raw = np.frombuffer(tex.getRamImageAs("R"), dtype=dtype)
+        # Texture RAM images are stored bottom row first, so rows are world y.
+        return raw.reshape(img.getYSize(), img.getXSize()).astype(np.float32) / img.getMaxval()
+
+    def _cells(self, xs, ys):
+        xs = np.clip(np.asarray(xs, dtype=np.float32), 0, self.size_x - 1)
+        ys = np.clip(np.asarray(ys, dtype=np.float32), 0, self.size_y - 1)
+        x0 = np.minimum(xs.astype(np.intp), self.size_x - 2)
+        y0 = np.minimum(ys.astype(np.intp), self.size_y - 2)
+        h = self.heights
+        return (
+            xs - x0,
+            ys - y0,
+            h[y0, x0],
+            h[y0, x0 + 1],
+            h[y0 + 1, x0],
+            h[y0 + 1, x0 + 1],
+        )
+
+    def heights_at(self, xs, ys):
+        fx, fy, h00, h10, h01, h11 = self._cells(xs, ys)
+        bottom = h00 + (h10 - h00) * fx
+        top = h01 + (h11 - h01) * fx
+        return bottom + (top - bottom) * fy
+
+    def height_at(self, x, y):
+        return float(self.heights_at(x, y))
+
+    def gradients_at(self, xs, ys):
+        fx, fy, h00, h10, h01, h11 = self._cells(xs, ys)
+        dx = (h10 - h00) + ((h11 - h01) - (h10 - h00)) * fy
+        dy = (h01 - h00) + ((h11 - h10) - (h01 - h00)) * fx
+        return dx, dy
+
+    def normals_at(self, xs, ys):
+        dx, dy = self.gradients_at(xs, ys)
+        normals = np.stack([-dx, -dy, np.ones_like(dx)], axis=-1)
+        return normals / np.linalg.norm(normals, axis=-1, keepdims=True)
+
+    def raycast(self, origins, directions, max_dist, step=0.5):
+        # Distance along each ray to the first ground crossing, or inf.
+        origins = np.atleast_2d(np.asarray(origins, dtype=np.float32))
+        directions = np.atleast_2d(np.asarray(directions, dtype=np.float32))
+        directions = directions / np.linalg.norm(directions, axis=1, keepdims=True)
+        ts = np.arange(0, max_dist + step, step, dtype=np.float32)
+        points = origins[:, None, :] + directions[:, None, :] * ts[None, :, None]
+        above = points[..., 2] - self.heights_at(points[..., 0], points[..., 1])
+        below = above <= 0
+        hit = below.any(axis=1)
+        first = np.argmax(below, axis=1)
+        rows = np.arange(len(origins))
+        prev = np.maximum(first - 1, 0)
+        a0 = above[rows, prev]
+        a1 = above[rows, first]
+        frac = np.where(first > 0, a0 / np.maximum(a0 - a1, 1e-6), 0)
+        dist = ts[prev] + (ts[first] - ts[prev]) * frac
+        return np.where(hit, dist, np.inf)
+
+
+class TerrainPager:
+    def __init__(
+        self,
+        name,
+        heightfield_path,
+        focal_point,
+        chunk_size=128,
+        radius=256,
+        lod_threshold=2,
+        pages_per_update=1,
+        bake=None,
+    ):
+        self.name = name
+        self.focal_point = focal_point
+        self.chunk_size = chunk_size
+        self.radius = radius
+        self.lod_threshold = lod_threshold
+        self.pages_per_update = pages_per_update
+
+        # Only the header is read here; the image itself is only needed to
+        # cut chunks that were not baked.
+        self.heightfield_path = heightfield_path
+        self.image = None
+        header = PNMImageHeader()
+        header.readHeader(Filename(heightfield_path))
+        self.size_x = header.getXSize()
+        self.size_y = header.getYSize()
+        if (self.size_x - 1) % chunk_size or (self.size_y - 1) % chunk_size:
+            raise ValueError(
+                f"{heightfield_path} is {self.size_x}x{self.size_y}, "
+                f"which does not split into {chunk_size} unit chunks"
+            )
+        self.chunks_x = (self.size_x - 1) // chunk_size
+        self.chunks_y = (self.size_y - 1) // chunk_size
+        self.color_map = PNMImage(chunk_size + 1, chunk_size + 1, 3)
+        self.color_map.fillVal(163, 69, 41)
+
+        # Baked chunk heightfields are still turned into GeoMipTerrains with
+        # their usual LOD; the bake only saves cutting them from the source.
+        self.baked = bake and bake.find(f"heightfield{chunk_size}", "", heightfield_path)
+        self.root = NodePath(name)
+        self.chunks = {}
+        self.terrains = {}
+        self.pending = []
+        self.last_page_pos = None
+        self.last_lod_pos = None
+
+    def chunk_bounds(self, cx, cy):
+        x0 = cx * self.chunk_size
+        y0 = cy * self.chunk_size
+        return x0, y0, x0 + self.chunk_size, y0 + self.chunk_size
+
+    def wanted_chunks(self, x, y):
+        wanted = set()
+        for cy in range(self.chunks_y):
+            for cx in range(self.chunks_x):
+                x0, y0, x1, y1 = self.chunk_bounds(cx, cy)
+                dx = max(x0 - x, 0, x - x1)
+                dy = max(y0 - y, 0, y - y1)
+                if dx * dx + dy * dy <= self.radius * self.radius:
+                    wanted.add((cx, cy))
+        return wanted
+
+    def chunk_name(self, cx, cy):
+        return f"{self.name}_{cx}_{cy}"
+
+    @staticmethod
+    def chunk_file(cx, cy):
+        return f"{cx}_{cy}.png"
+
+    def chunk_heightfield(self, cx, cy):
+        if self.image is None:
+            self.image = PNMImage(Filename(self.heightfield_path))
+        x0, _y0, _x1, y1 = self.chunk_bounds(cx, cy)
+        heightfield = PNMImage(self.chunk_size + 1, self.chunk_size + 1, 1)
+        heightfield.setMaxval(self.image.getMaxval())
+        # Image rows run from the top (max y) of the map down.
+        heightfield.copySubImage(
+            self.image,
+            0,
+            0,
+            x0,
+            self.size_y - 1 - y1,
+            self.chunk_size + 1,
+            self.chunk_size + 1,
+        )
+        return heightfield
+
+    def build_chunk(self, cx, cy):
+        terrain = GeoMipTerrain(self.chunk_name(cx, cy))
+        # A missing or unreadable baked chunk is cut from the source instead.
+        if not (
+            self.baked
+            and terrain.setHeightfield(Filename(f"{self.baked}/{self.chunk_file(cx, cy)}"))
+        ):
+            terrain.setHeightfield(self.chunk_heightfield(cx, cy))
+        terrain.set_color_map(self.color_map)
+        terrain.set_focal_point(self.focal_point)
+        terrain.generate()
+        return terrain
+
+    def page_in(self, cx, cy):
+        x0, y0, _x1, _y1 = self.chunk_bounds(cx, cy)
+        terrain = self.build_chunk(cx, cy)
+        chunk = terrain.get_root()
+        self.terrains[cx, cy] = terrain
+        chunk.set_pos(x0, y0, 0)
+        chunk.reparent_to(self.root)
+        chunk.setCollideMask(BitMask32.allOff())
+        self.chunks[cx, cy] = chunk
+
+    def page_out(self, cx, cy):
+        self.chunks.pop((cx, cy)).remove_node()
+        self.terrains.pop((cx, cy), None)
+
+    def generate(self):
+        self.update(force=True)
+
+    def update(self, force=False):
+        # Pages in at most pages_per_update chunks per call, nearest first,
+        # so a long move costs several small updates instead of one big one.
+        pos = self.focal_point.get_pos(self.root)
+        if (
+            force
+            or (pos.xy - self.last_page_pos).length() > self.chunk_size / 4
+        ):
+            self.last_page_pos = pos.xy
+            wanted = self.wanted_chunks(pos.x, pos.y)
+            for key in self.chunks.keys() - wanted:
+                self.page_out(*key)
+            half = self.chunk_size / 2
+            self.pending = sorted(
+                wanted - self.chunks.keys(),
+                key=lambda key: (key[0] * self.chunk_size + half - pos.x) ** 2
+                + (key[1] * self.chunk_size + half - pos.y) ** 2,
+                reverse=True,
+            )
+        if self.pending:
+            count = len(self.pending) if force else self.pages_per_update
+            for _ in range(min(count, len(self.pending))):
+                self.page_in(*self.pending.pop())
+            force = True
+        if force or (pos - self.last_lod_pos).length() > self.lod_threshold:
+            self.last_lod_pos = pos
+            for terrain in self.terrains.values():
+                terrain.update()
+
+    def destroy(self):
+        for key in list(self.chunks):
+            self.page_out(*key)
+        self.root.remove_node()
+
+
+class SceneCells:
+    # Level objects live in square cells so the cull traversal can reject a
+    # whole cell on its bounds, and cells past far_distance are hidden
+    # outright. Hiding leaves collisions alone. Static objects are flattened
+    # together per cell; keep=True preserves a node's own transform for
+    # objects that gameplay still queries.
+    def __init__(self, base, parent, focus, cell_size=32, far_distance=256, interval=0.25):
+        self.base = base
+        self.focus = focus
+        self.cell_size = cell_size
+        self.far_distance = far_distance
+        self.interval = interval
+        self.root = parent.attachNewNode("cells")
+        self.cells = {}
+        self.job = None
+
+    def cell(self, node):
+        pos = node.get_pos(self.root)
+        key = (math.floor(pos.x / self.cell_size), math.floor(pos.y / self.cell_size))
+        if key not in self.cells:
+            cell = self.root.attachNewNode(f"cell_{key[0]}_{key[1]}")
+            self.cells[key] = (cell, cell.attachNewNode("static"))
+        return self.cells[key]
+
+    def add(self, node):
+        node.wrtReparentTo(self.cell(node)[0])
+
+    def add_static(self, node, keep=False):
+        if keep:
+            node.node().setPreserveTransform(ModelNode.PT_local)
+        node.wrtReparentTo(self.cell(node)[1])
+
+    def flatten(self):
+        for _cell, static in self.cells.values():
+            static.flattenStrong()
+
+    def start(self):
+        self.job = self.base.scheduler.add(
+            "Cells", self.update, priority=3, rate=1 / self.interval
+        )
+
+    def stop(self):
+        if self.job:
+            self.job.remove()
+            self.job = None
+
+    def update(self):
+        pos = self.focus.get_pos(self.root)
+        size = self.cell_size
+        for (cx, cy), (cell, _static) in self.cells.items():
+            dx = max(cx * size - pos.x, 0, pos.x - (cx + 1) * size)
+            dy = max(cy * size - pos.y, 0, pos.y - (cy + 1) * size)
+            if dx * dx + dy * dy <= self.far_distance**2:
+                cell.show()
+            else:
+                cell.hide()
+
+    def counts(self):
+        hidden = sum(cell.isHidden() for cell, _static in self.cells.values())
+        return {"cells": len(self.cells), "hidden": hidden}
+
+    def destroy(self):
+        self.stop()
+        self.root.remove_node()
+        self.cells.clear()
+
+
+def segment_capsule_distances(p0, p1, a, b):
+    # Closest distance between each segment p0[i]->p1[i] and the segment a->b.
+    d1 = p1 - p0
+    d2 = b - a
+    r = p0 - a
+    aa = np.maximum(np.einsum("ij,ij->i", d1, d1), 1e-12)
+    e = max(float(d2 @ d2), 1e-12)
+    f = r @ d2
+    c = np.einsum("ij,ij->i", d1, r)
+    bb = d1 @ d2
+    denom = aa * e - bb * bb
+    s = np.where(denom > 1e-12, np.clip((bb * f - c * e) / np.maximum(denom, 1e-12), 0, 1), 0)
+    t = (bb * s + f) / e
+    s = np.where(t < 0, np.clip(-c / aa, 0, 1), np.where(t > 1, np.clip((bb - c) / aa, 0, 1), s))
+    t = np.clip(t, 0, 1)
+    closest = p0 + d1 * s[:, None] - (a + d2 * t[:, None])
+    return np.sqrt(np.einsum("ij,ij->i", closest, closest))
+
+
+class ProjectileSystem:
+    notify = directNotify.newCategory("ProjectileSystem")
+
+    def __init__(self, model, render, ground_heights, capacity=128):
+        self.ground_heights = ground_heights
+        self.capacity = capacity
+        self.speed = 30
+        self.max_dist = 50
+        self.radius = 0.01
+
+        self.pos = np.zeros((capacity, 3), dtype=np.float32)
+        self.prev = np.zeros((capacity, 3), dtype=np.float32)
+        self.dir = np.zeros((capacity, 3), dtype=np.float32)
+        self.dist = np.zeros(capacity, dtype=np.float32)
+        self.owner = np.full(capacity, -1, dtype=np.int64)
+        self.alive = np.zeros(capacity, dtype=bool)
+        self.fired_at = np.zeros(capacity, dtype=np.int64)
+
+        self.blocker_centres = np.zeros((0, 3), dtype=np.float32)
+        self.blocker_radii = np.zeros(0, dtype=np.float32)
+
+        self.root = render.attachNewNode("projectiles")
+        model.setScale(0.05)
+        self.nodes = []
+        for i in range(capacity):
+            node = self.root.attachNewNode(f"bullet{i}")
+            model.instanceTo(node)
+            node.stash()
+            self.nodes.append(node)
+
+        self.free = list(range(capacity - 1, -1, -1))
+        self.fired = 0
+        self.stolen = 0
+        self.peak = 0
+
+    def add_blocker(self, centre, radius):
+        self.blocker_centres = np.vstack(
+            [self.blocker_centres, np.array(centre, dtype=np.float32)]
+        )
+        self.blocker_radii = np.append(self.blocker_radii, np.float32(radius))
+
+    def add_blocker_node(self, node):
+        bounds = node.getBounds()
+        self.add_blocker(bounds.getCenter(), bounds.getRadius())
+
+    def fire(self, origin, target, owner=-1):
+        if self.free:
+            i = self.free.pop()
+        else:
+            # Recycle the oldest bullet in flight rather than dropping the shot.
+            alive = np.flatnonzero(self.alive)
+            i = int(alive[np.argmin(self.fired_at[alive])])
+            self.stolen += 1
+            if self.stolen == 1:
+                self.notify.warning(f"pool exhausted at {self.capacity} bullets")
+        direction = Vec3(target - origin)
+        direction.normalize()
+        self.pos[i] = origin
+        self.prev[i] = origin
+        self.dir[i] = direction
+        self.dist[i] = 0
+        self.owner[i] = owner
+        self.fired_at[i] = self.fired
+        if not self.alive[i]:
+            self.alive[i] = True
+            self.nodes[i].unstash()
+        self.nodes[i].set_pos(origin)
+        self.nodes[i].look_at(target)
+        self.fired += 1
+        self.peak = max(self.peak, int(self.alive.sum()))
+        return i
+
+    def release(self, indices):
+        for i in indices:
+            i = int(i)
+            if self.alive[i]:
+                self.alive[i] = False
+                self.owner[i] = -1
+                self.nodes[i].stash()
+                self.free.append(i)
+
+    def step(self, dt, capsule_a, capsule_b, capsule_radius):
+        idx = np.flatnonzero(self.alive)
+        if not len(idx):
+            return 0
+        p0 = self.pos[idx]
+        p1 = p0 + self.dir[idx] * (self.speed * dt)
+        self.prev[idx] = p0
+        self.pos[idx] = p1
+        self.dist[idx] += self.speed * dt
+
+        hit_player = (
+            segment_capsule_distances(
+                p0, p1, np.asarray(capsule_a, dtype=np.float32), np.asarray(capsule_b, dtype=np.float32)
+            )
+            <= capsule_radius + self.radius
+        )
+        spent = hit_player | (self.dist[idx] > self.max_dist)
+        spent |= p1[:, 2] <= self.ground_heights(p1[:, 0], p1[:, 1])
+        if len(self.blocker_radii):
+            offsets = p1[:, None, :] - self.blocker_centres[None, :, :]
+            inside = np.einsum("ijk,ijk->ij", offsets, offsets) <= self.blocker_radii**2
+            spent |= inside.any(axis=1)
+
+        self.release(idx[spent])
+        return int(hit_player.sum())
+
+    def sync(self, alpha):
+        idx = np.flatnonzero(self.alive)
+        shown = self.prev[idx] + (self.pos[idx] - self.prev[idx]) * alpha
+        for i, (x, y, z) in zip(idx.tolist(), shown.tolist()):
+            self.nodes[i].set_fluid_pos(x, y, z)
+
+    def snapshot(self):
+        # The free list is saved too: it decides which slot the next shot
+        # takes, and so the order bullets are stepped and checksummed in.
+        arrays = (self.pos, self.prev, self.dir, self.dist, self.owner, self.alive, self.fired_at)
+        return tuple(array.copy() for array in arrays), list(self.free)
+
+    def restore(self, state):
+        arrays, free = state
+        self.release(np.flatnonzero(self.alive))
+        for array, saved in zip(
+            (self.pos, self.prev, self.dir, self.dist, self.owner, self.alive, self.fired_at), arrays
+        ):
+            array[:] = saved
+        self.free = list(free)
+        for i in np.flatnonzero(self.alive).tolist():
+            self.nodes[i].unstash()
+            self.nodes[i].look_at(Point3(*(self.pos[i] + self.dir[i])))
+        self.sync(1)
+
+    def pressure(self):
+        return {
+            "capacity": self.capacity,
+            "in_use": int(self.alive.sum()),
+            "peak": self.peak,
+            "fired": self.fired,
+            "stolen": self.stolen,
+        }
+
+    def destroy(self):
+        self.release(np.flatnonzero(self.alive))
+        self.root.remove_node()
+
+
+class SpatialHashGrid:
+    def __init__(self, cell_size):
+        self.cell_size = cell_size
+        self.cells = {}
+        self.cell_of = {}
+
+    def key(self, x, y):
+        return int(x // self.cell_size), int(y // self.cell_size)
+
+    def insert(self, item, x, y):
+        key = self.key(x, y)
+        self.cells.setdefault(key, set()).add(item)
+        self.cell_of[item] = key
+
+    def move(self, item, x, y):
+        key = self.key(x, y)
+        old = self.cell_of[item]
+        if key == old:
+            return
+        self.cells[old].discard(item)
+        if not self.cells[old]:
+            del self.cells[old]
+        self.cells.setdefault(key, set()).add(item)
+        self.cell_of[item] = key
+
+    def __contains__(self, item):
+        return item in self.cell_of
+
+    def remove(self, item):
+        key = self.cell_of.pop(item, None)
+        if key is None:
+            return
+        self.cells[key].discard(item)
+        if not self.cells[key]:
+            del self.cells[key]
+
+    def query(self, x, y, radius):
+        x0, y0 = self.key(x - radius, y - radius)
+        x1, y1 = self.key(x + radius, y + radius)
+        for cx in range(x0, x1 + 1):
+            for cy in range(y0, y1 + 1):
+                yield from self.cells.get((cx, cy), ())
+
+    def __len__(self):
+        return len(self.cell_of)
+
+
+class TriggerZone:
+    __slots__ = ("name", "lo", "hi", "centre", "radius", "enter_event", "exit_event", "inside")
+
+    def __init__(self, name, enter_event, exit_event, centre=None, radius=None, lo=None, hi=None):
+        self.name = name
+        self.enter_event = enter_event
+        self.exit_event = exit_event
+        self.centre = centre
+        self.radius = radius
+        if centre is not None:
+            lo = centre - Vec3(radius)
+            hi = centre + Vec3(radius)
+        self.lo = Point3(lo)
+        self.hi = Point3(hi)
+        self.inside = False
+
+    def distance(self, point):
+        if self.centre is not None:
+            return max(0, (point - self.centre).length() - self.radius)
+        excess = Vec3(
+            max(self.lo.x - point.x, 0, point.x - self.hi.x),
+            max(self.lo.y - point.y, 0, point.y - self.hi.y),
+            max(self.lo.z - point.z, 0, point.z - self.hi.z),
+        )
+        return excess.length()
+
+
+class TriggerSystem:
+    def __init__(self, focus, cell_size=16, hysteresis=1):
+        self.focus = focus
+        self.cell_size = cell_size
+        self.hysteresis = hysteresis
+        self.cells = {}
+        self.zones = {}
+        self.cell = None
+        self.candidates = ()
+
+    def cell_range(self, zone):
+        margin = self.hysteresis
+        x0 = int((zone.lo.x - margin) // self.cell_size)
+        y0 = int((zone.lo.y - margin) // self.cell_size)
+        x1 = int((zone.hi.x + margin) // self.cell_size)
+        y1 = int((zone.hi.y + margin) // self.cell_size)
+        return [(x, y) for x in range(x0, x1 + 1) for y in range(y0, y1 + 1)]
+
+    def add(self, zone):
+        self.zones[zone.name] = zone
+        for key in self.cell_range(zone):
+            self.cells.setdefault(key, []).append(zone)
+        self.cell = None
+        return zone
+
+    def add_sphere(self, name, centre, radius, enter_event, exit_event):
+        return self.add(TriggerZone(name, enter_event, exit_event, centre=centre, radius=radius))
+
+    def add_box(self, name, lo, hi, enter_event, exit_event):
+        return self.add(TriggerZone(name, enter_event, exit_event, lo=lo, hi=hi))
+
+    def remove(self, name):
+        zone = self.zones.pop(name)
+        for key in self.cell_range(zone):
+            self.cells[key].remove(zone)
+        self.cell = None
+        if zone.inside:
+            messenger.send(zone.exit_event, [zone])
+
+    def update(self):
+        pos = self.focus.get_pos()
+        cell = int(pos.x // self.cell_size), int(pos.y // self.cell_size)
+        if cell != self.cell:
+            self.cell = cell
+            previous = self.candidates
+            self.candidates = self.cells.get(cell, ())
+            for zone in previous:
+                if zone.inside and zone not in self.candidates:
+                    zone.inside = False
+                    messenger.send(zone.exit_event, [zone])
+        for zone in self.candidates:
+            distance = zone.distance(pos)
+            if not zone.inside and distance <= 0:
+                zone.inside = True
+                messenger.send(zone.enter_event, [zone])
+            elif zone.inside and distance > self.hysteresis:
+                zone.inside = False
+                messenger.send(zone.exit_event, [zone])
+
+    def reset(self):
+        for zone in self.zones.values():
+            zone.inside = False
+        self.cell = None
+        self.candidates = ()
+
+
+class Hitscan:
+    def __init__(self, render, heightfield, mask, max_dist=100):
+        self.render = render
+        self.heightfield = heightfield
+        self.mask = mask
+        self.max_dist = max_dist
+        self.traverser = CollisionTraverser("hitscan")
+        self.queue = CollisionHandlerQueue()
+        self.root = render.attachNewNode("hitscan")
+        self.rays = []
+
+    def reserve(self, count):
+        while len(self.rays) < count:
+            ray_node = CollisionNode(f"hitscan_ray{len(self.rays)}")
+            ray_node.addSolid(CollisionSegment())
+            ray_node.setFromCollideMask(self.mask)
+            ray_node.setIntoCollideMask(0)
+            self.rays.append(self.root.attachNewNode(ray_node))
+
+    def query(self, origin, direction):
+        return self.query_many([origin], [direction])[0]
+
+    def query_many(self, origins, directions):
+        # Returns (into_node, point, distance) for the nearest hit of each
+        # ray; into_node is None when terrain or nothing was hit first.
+        self.reserve(len(origins))
+        for ray, origin, direction in zip(self.rays, origins, directions):
+            direction = Vec3(direction).normalized()
+            ray.node().modifySolid(0).setPointA(origin)
+            ray.node().modifySolid(0).setPointB(origin + direction * self.max_dist)
+            self.traverser.addCollider(ray, self.queue)
+        self.traverser.traverse(self.render)
+        self.traverser.clearColliders()
+        self.queue.sortEntries()
+
+        ground = self.heightfield.raycast(origins, directions, self.max_dist)
+        results = [(None, None, float(d)) for d in ground]
+        done = set()
+        index = {ray.node(): i for i, ray in enumerate(self.rays[: len(origins)])}
+        for entry in self.queue.entries:
+            i = index[entry.getFromNode()]
+            if i in done:
+                continue
+            done.add(i)
+            point = entry.getSurfacePoint(self.render)
+            dist = (point - Point3(*origins[i])).length()
+            if dist <= results[i][2]:
+                results[i] = (entry.getIntoNode(), point, dist)
+        self.queue.clearEntries()
+        return results
+
+
+class EntityStore:
+    ALIVE = 1
+    DYING = 2
+
+    def __init__(self, capacity=64):
+        self.capacity = 0
+        self.hp = np.zeros(0, dtype=np.float32)
+        self.pos = np.zeros((0, 3), dtype=np.float32)
+        self.flags = np.zeros(0, dtype=np.uint8)
+        self.timer = np.zeros(0, dtype=np.float64)
+        self.interval = np.zeros(0, dtype=np.float32)
+        self.nodes = []
+        self.handles = []
+        self.bound = []
+        self.id_of_node = {}
+        self.free = []
+        self.dead = []
+        self.grow(capacity)
+
+    def grow(self, capacity):
+        extra = capacity - self.capacity
+        self.hp = np.concatenate([self.hp, np.zeros(extra, dtype=np.float32)])
+        self.pos = np.concatenate([self.pos, np.zeros((extra, 3), dtype=np.float32)])
+        self.flags = np.concatenate([self.flags, np.zeros(extra, dtype=np.uint8)])
+        self.timer = np.concatenate([self.timer, np.zeros(extra, dtype=np.float64)])
+        self.interval = np.concatenate([self.interval, np.zeros(extra, dtype=np.float32)])
+        self.nodes.extend([None] * extra)
+        self.handles.extend([None] * extra)
+        self.bound.extend([None] * extra)
+        self.free.extend(range(capacity - 1, self.capacity - 1, -1))
+        self.capacity = capacity
+
+    def spawn(self, handle, node, pos, hp, i=None):
+        # i picks a specific free id, e.g. to keep one per placed spawn.
+        if i is not None:
+            self.free.remove(i)
+        else:
+            if not self.free:
+                self.grow(self.capacity * 2)
+            i = self.free.pop()
+        self.hp[i] = hp
+        self.pos[i] = pos
+        self.flags[i] = self.ALIVE
+        self.timer[i] = 0
+        self.interval[i] = 0
+        self.nodes[i] = node
+        self.handles[i] = handle
+        return i
+
+    def bind(self, i, panda_node):
+        self.bound[i] = panda_node
+        self.id_of_node[panda_node] = i
+
+    def id_of(self, panda_node):
+        return self.id_of_node.get(panda_node)
+
+    def despawn(self, i):
+        if self.handles[i] is None:
+            return
+        self.flags[i] = 0
+        self.nodes[i] = None
+        self.handles[i] = None
+        if self.bound[i] is not None:
+            del self.id_of_node[self.bound[i]]
+            self.bound[i] = None
+        self.free.append(i)
+
+    def apply_damage(self, ids, damage):
+        ids = np.unique(np.asarray(ids, dtype=np.intp))
+        ids = ids[(self.flags[ids] & self.ALIVE).astype(bool)]
+        self.hp[ids] -= damage
+        died = ids[self.hp[ids] <= 0]
+        self.flags[died] = self.DYING
+        self.dead.extend(died.tolist())
+        return died
+
+    def collect_dead(self):
+        dead, self.dead = self.dead, []
+        return dead
+
+    def alive_ids(self):
+        return np.flatnonzero(self.flags & self.ALIVE)
+
+    def snapshot(self):
+        return (
+            self.hp.copy(),
+            self.pos.copy(),
+            self.flags.copy(),
+            self.timer.copy(),
+            list(self.dead),
+        )
+
+    def restore(self, state):
+        hp, pos, flags, timer, dead = state
+        n = len(hp)
+        self.hp[:n], self.pos[:n], self.flags[:n], self.timer[:n] = hp, pos, flags, timer
+        self.flags[n:] = 0
+        self.dead = list(dead)
+
+
+class AISystem:
+    def __init__(self, player, entities, engage_radius=20, cell_size=16):
+        self.player = player
+        self.entities = entities
+        self.engage_radius = engage_radius
+        self.grid = SpatialHashGrid(cell_size)
+        self.engaged = 0
+        self.now = 0.0
+
+    def add(self, alien, interval):
+        self.entities.interval[alien.id] = interval
+        self.entities.timer[alien.id] = self.now + interval
+        x, y, _z = self.entities.pos[alien.id]
+        self.grid.insert(alien.id, x, y)
+
+    def moved(self, alien):
+        # Updates the cell of an alien whose node was repositioned. One the
+        # grid dropped when it died is put back, e.g. when a restore revives it.
+        self.entities.pos[alien.id] = alien.node.get_pos()
+        x, y, _z = self.entities.pos[alien.id]
+        if alien.id in self.grid:
+            self.grid.move(alien.id, x, y)
+        else:
+            self.grid.insert(alien.id, x, y)
+
+    def remove(self, alien):
+        self.grid.remove(alien.id)
+
+    def reset(self, now):
+        self.now = now
+
+    def update(self, now):
+        self.now = now
+        ppos = self.player.node.get_pos()
+        ids = np.fromiter(
+            self.grid.query(ppos.x, ppos.y, self.engage_radius), dtype=np.intp
+        )
+        if not len(ids):
+            self.engaged = 0
+            return []
+        offsets = self.entities.pos[ids] - np.array(ppos, dtype=np.float32)
+        engaged = ids[
+            np.einsum("ij,ij->i", offsets, offsets) <= self.engage_radius**2
+        ]
+        self.engaged = len(engaged)
+        ready = engaged[self.entities.timer[engaged] <= now]
+        self.entities.timer[ready] = now + self.entities.interval[ready]
+        fired = ready.tolist()
+        for i in fired:
+            self.entities.handles[i].engage()
+        return fired
+
+    def destroy(self):
+        self.grid = SpatialHashGrid(self.grid.cell_size)
+
+
+class AnimationLOD:
+    # Living aliens near the focus animate on their own Actor. Further out
+    # they show an instance of one shared crowd Actor, posed at a reduced
+    # rate so its skeleton is skinned once for all of them, and beyond
+    # far_distance they freeze on their current frame, drawn as billboards
+    # in one batched impostor layer when one is given. Off-screen Actors are
+    # already skipped by the cull traversal.
+    OWN = 0
+    SHARED = 1
+    FROZEN = 2
+
+    def __init__(
+        self,
+        base,
+        entities,
+        focus,
+        anim,
+        near_distance=15,
+        far_distance=60,
+        rate=12,
+        impostors=None,
+    ):
+        self.base = base
+        self.entities = entities
+        self.focus = focus
+        self.anim = anim
+        self.near_distance = near_distance
+        self.far_distance = far_distance
+        self.rate = rate
+        self.impostors = impostors
+        self.crowd = None
+        self.instances = {}
+        self.states = {}
+        self.frame = -1
+        self.job = None
+
+    def add(self, alien):
+        if self.crowd is None:
+            self.crowd = Actor(other=alien.actor)
+            self.crowd.clearTransform()
+            self.frames = self.crowd.getNumFrames(self.anim)
+            self.fps = self.crowd.getFrameRate(self.anim)
+            if self.impostors:
+                lo, hi = alien.actor.getTightBounds(alien.node)
+                self.impostors.resize(max(hi.x - lo.x, hi.y - lo.y), lo.z, hi.z)
+                self.crowd.pose(self.anim, 0)
+                self.impostors.capture(self.crowd, alien.actor.getTransform(), lo, hi)
+        instance = alien.node.attachNewNode("crowd_instance")
+        instance.setTransform(alien.actor.getTransform())
+        instance.hide()
+        self.crowd.instanceTo(instance)
+        self.instances[alien.id] = instance
+        self.states[alien.id] = self.OWN
+
+    def remove(self, alien):
+        self.instances.pop(alien.id).remove_node()
+        del self.states[alien.id]
+        alien.actor.show()
+
+    def start(self):
+        self.job = self.base.scheduler.add(
+            "AnimationLOD", self.update, priority=1, rate=self.rate
+        )
+
+    def stop(self):
+        if self.job:
+            self.job.remove()
+            self.job = None
+
+    def set_state(self, i, state):
+        actor = self.entities.handles[i].actor
+        if state == self.SHARED:
+            actor.stop()
+            actor.hide()
+            self.instances[i].show()
+        elif state == self.OWN:
+            self.instances[i].hide()
+            actor.show()
+            actor.loop(self.anim)
+        else:
+            self.instances[i].hide()
+            actor.stop()
+            if self.impostors:
+                actor.hide()
+        self.states[i] = state
+
+    def wake(self, alien):
+        # Hands an alien back to its own Actor, e.g. to play a one-off.
+        if self.states[alien.id] != self.OWN:
+            self.set_state(alien.id, self.OWN)
+
+    def reset(self):
+        # Called after the Actors were posed directly, e.g. by a restore.
+        for i, instance in self.instances.items():
+            instance.hide()
+            self.entities.handles[i].actor.show()
+            self.states[i] = self.OWN
+        if self.impostors:
+            self.impostors.update(np.zeros((0, 3), dtype=np.float32), self.focus.get_pos())
+
+    def counts(self):
+        counts = [0, 0, 0]
+        for state in self.states.values():
+            counts[state] += 1
+        return dict(zip(("own", "shared", "frozen"), counts))
+
+    def update(self):
+        ids = self.entities.alive_ids()
+        offsets = self.entities.pos[ids] - np.array(self.focus.get_pos(), dtype=np.float32)
+        dist2 = np.einsum("ij,ij->i", offsets, offsets)
+        wanted = np.where(
+            dist2 < self.near_distance**2,
+            self.OWN,
+            np.where(dist2 < self.far_distance**2, self.SHARED, self.FROZEN),
+        )
+        for i, state in zip(ids.tolist(), wanted.tolist()):
+            if self.states[i] != state:
+                self.set_state(i, state)
+        if self.impostors:
+            far = ids[wanted == self.FROZEN]
+            self.impostors.update(self.entities.pos[far], self.focus.get_pos())
+        if self.crowd is not None:
+            frame = int(globalClock.getFrameTime() * self.fps) % self.frames
+            if frame != self.frame:
+                self.crowd.pose(self.anim, frame)
+                self.frame = frame
+
+    def destroy(self):
+        self.stop()
+        for instance in self.instances.values():
+            instance.remove_node()
+        self.instances.clear()
+        if self.crowd is not None:
+            self.crowd.cleanup()
+            self.crowd.remove_node()
+            self.crowd = None
+        if self.impostors:
+            self.impostors.destroy()
+
+
+class Spawner:
+    # Creates the level's placed aliens region by region: a region's spawns
+    # are activated when the focus comes within radius of it and retired
+    # once the focus is more than radius + hysteresis away, so only the
+    # aliens around the player exist. Spawn k always uses entity id k, whose
+    # hp and position persist while it is retired; dead spawns stay dead.
+    # Runs as a simulation system, so it replays deterministically.
+    def __init__(
+        self,
+        entities,
+        focus,
+        points,
+        hp,
+        activate,
+        retire,
+        region_size=32,
+        radius=96,
+        hysteresis=16,
+    ):
+        self.entities = entities
+        self.focus = focus
+        self.activate = activate
+        self.retire = retire
+        self.region_size = region_size
+        self.radius = radius
+        self.hysteresis = hysteresis
+        n = len(points)
+        if entities.capacity < n:
+            entities.grow(n)
+        entities.pos[:n] = points
+        entities.hp[:n] = hp
+        keys = np.floor(points[:, :2] / region_size).astype(np.int64)
+        self.regions, index = np.unique(keys, axis=0, return_inverse=True)
+        index = index.reshape(-1)
+        order = np.argsort(index, kind="stable")
+        ends = np.cumsum(np.bincount(index, minlength=len(self.regions)))
+        self.members = np.split(order, ends[:-1])
+        self.active = np.zeros(len(self.regions), dtype=bool)
+        self.last_pos = None
+
+    def update(self, force=False):
+        pos = self.focus.get_pos()
+        if (
+            not force
+            and self.last_pos is not None
+            and (pos.xy - self.last_pos).length() < self.region_size / 8
+        ):
+            return
+        self.last_pos = Point2(pos.xy)
+        lo = self.regions * self.region_size
+        offsets = np.maximum(
+            np.maximum(lo - (pos.x, pos.y), 0), (pos.x, pos.y) - (lo + self.region_size)
+        )
+        dist2 = np.einsum("ij,ij->i", offsets, offsets)
+        leave = self.active & (dist2 > (self.radius + self.hysteresis) ** 2)
+        enter = ~self.active & (dist2 <= self.radius**2)
+        handles = self.entities.handles
+        for region in np.flatnonzero(leave):
+            for i in self.members[region].tolist():
+                if handles[i] is not None:
+                    self.retire(i)
+        for region in np.flatnonzero(enter):
+            for i in self.members[region].tolist():
+                if self.entities.hp[i] > 0:
+                    self.activate(i)
+        self.active ^= leave | enter
+
+    def counts(self):
+        spawned = sum(handle is not None for handle in self.entities.handles)
+        return {
+            "regions": len(self.regions),
+            "active": int(self.active.sum()),
+            "spawned": spawned,
+        }
+
+    def snapshot(self):
+        last_pos = None if self.last_pos is None else Point2(self.last_pos)
+        return self.active.copy(), last_pos
+
+    def restore(self, state, ids):
+        # Brings back exactly the spawned set of a snapshot; the caller
+        # restores their entity state afterwards.
+        active, last_pos = state
+        self.active = active.copy()
+        self.last_pos = None if last_pos is None else Point2(last_pos)
+        wanted = set(ids)
+        handles = self.entities.handles
+        for i, handle in enumerate(handles):
+            if handle is not None and i not in wanted:
+                self.retire(i)
+        for i in sorted(wanted):
+            if handles[i] is None:
+                self.activate(i)
+
+
 class Alien:
+    __slots__ = (
+        "entities",
+        "id",
+        "node",
+        "player",
+        "projectiles",
+        "actor",
+        "proxy",
+    )
+
     def __init__(
         self,
+        entities,
         node,
-        initial_pos,
         player,
-        loader,
-        render,
-        task_mgr,
-        cTrav,
-        enemy_bullet_hit_queue,
+        projectiles,
+        actor,
     ):
+        self.entities = entities
+        self.id = None
         self.node = node
         self.player = player
-        self.loader = loader
-        self.render = render
-        self.task_mgr = task_mgr
-        self.cTrav = cTrav
-        self.enemy_bullet_hit_queue = enemy_bullet_hit_queue
-        self.actor = Actor("assets/models/alien.bam")
+        self.projectiles = projectiles
+        self.actor = actor
         self.actor.reparent_to(self.node)
         self.actor.setScale(0.4, 0.5, 0.5)
         self.actor.set_h(180)
-        self.actor.setCollideMask(BitMask32.allOn())
-        self.initial_pos = initial_pos
-        self.node.set_pos(*initial_pos)
+        self.actor.setCollideMask(BitMask32.allOff())
+        proxy = self.node.attachNewNode(CollisionNode("alien_proxy"))
+        proxy.node().addSolid(CollisionCapsule(0, 0, 0.13, 0, 0, 0.22, 0.13))
+        proxy.node().setIntoCollideMask(enemy_mask)
+        proxy.node().setFromCollideMask(0)
+        self.proxy = proxy.node()
+
+    def spawn(self, i, pos, hp):
+        # Aliens are pooled, so this may reuse one retired under another id.
+        self.node.set_pos_hpr(*pos, 0, 0, 0)
+        self.node.unstash()
         self.actor.loop("CharacterArmature|Shoot")
-        self.hp = 100
+        self.id = self.entities.spawn(self, self.node, pos, hp, i)
+        self.entities.bind(self.id, self.proxy)
         # self.hp_bar = HealthBar()
         # self.hp_bar.reparent_to(self.node)
         # self.hp_bar.setBillboardPointEye(-10, fixed_depth=True)
         # self.hp_bar.setScale(0.5)
         # self.hp_bar.setPos(0, 0, 0.5)
 
+    @property
+    def hp(self):
+        return float(self.entities.hp[self.id])
+
     def take_damage(self, damage):
-        if self.hp <= 0:
-            return False
-        self.hp -= damage
         # self.hp_bar.setHealth(self.hp / 100)
-        if self.hp <= 0:
-            return True
-        return False
+        return len(self.entities.apply_damage([self.id], damage)) > 0
 
-    def update_task(self, task):
-        if (self.node.get_pos() - self.player.node.get_pos()).length() > 20:
-            return task.cont
+    def engage(self):
         self.node.lookAt(self.player.node)
-        bullet = NodePath("bullet")
-        bullet.reparent_to(self.render)
-        m = self.loader.load_model("assets/models/ball.bam")
-        m.setScale(0.05)
-        m.reparent_to(bullet)
-        bullet.set_pos(self.node, 0, 0, 0.5)
-        bullet.lookAt(self.player.node.get_pos() + Vec3(0, 0, 0.1))
-
-        bullet_col_node = CollisionNode("bullet_col_node")
-        bullet_col_node_path = bullet.attachNewNode(bullet_col_node)
-        bullet_cs = CollisionSphere(0, 0, 0, 0.01)
-        bullet_col_node_path.show()
-        bullet_col_node_path.setPythonTag("bullet", bullet)
-
-        bullet_col_node.addSolid(bullet_cs)
-        bullet_col_node.setFromCollideMask(ground_mask | player_mask | wall_mask)
-        bullet_col_node.setIntoCollideMask(0)
-        self.cTrav.addCollider(bullet_col_node_path, self.enemy_bullet_hit_queue)
-
-        def cb(task, bullet=bullet):
-            bullet.set_fluid_pos(bullet, 0, 0.5, 0)
-
-            d = bullet.getPythonTag("dist") or 0
-            if d > 50:
-                bullet.remove_node()
-                return task.done
-            bullet.setPythonTag("dist", d + 0.5)
-            return task.cont
-
-        self.task_mgr.add(cb, f"bullet{id(bullet)}_update")
-        return task.again
+        self.projectiles.fire(
+            self.projectiles.root.get_relative_point(self.node, Point3(0, 0, 0.5)),
+            self.player.node.get_pos() + Vec3(0, 0, 0.1),
+            self.id,
+        )
 
 
 class WinScreen:
@@ -206,7 +1943,7 @@ class WinScreen:
             "BACK TO MENU", lambda: fsm.request("MainMenu"), (0, 0, -0.6)
         )
         self.again_button = make_button(
-            "PLAY AGAIN", lambda: fsm.request("Level1"), (0, 0, -0.8)
+            "PLAY AGAIN", lambda: fsm.play(Level1), (0, 0, -0.8)
         )
 
     def destroy(self):
@@ -219,6 +1956,26 @@ class AppStateFSM(FSM):
     def __init__(self, base):
         super().__init__("AppStateFSM")
         self.base = base
+        self.warm = None
+
+    def play(self, level_class):
+        # Restart a suspended level in place instead of loading it again.
+        if type(self.warm) is level_class:
+            level, self.warm = self.warm, None
+            level.reset()
+            self.request(level_class.__name__, level)
+        else:
+            self.request("Loading", level_class)
+
+    def keep_warm(self, level):
+        self.drop_warm()
+        level.suspend()
+        self.warm = level
+
+    def drop_warm(self):
+        if self.warm:
+            self.warm.destroy()
+            self.warm = None
 
     def enterMainMenu(self):
         self.menu = MainMenu(self)
@@ -232,17 +1989,36 @@ class AppStateFSM(FSM):
     def exitHowToPlay(self):
         self.how_to_play.destroy()
 
-    def enterLevel1(self):
-        self.level1 = Level1(self, self.base)
+    def enterLoading(self, level_class):
+        self.drop_warm()
+        self.loading = LoadingScreen(self, level_class)
+
+    def exitLoading(self):
+        self.loading.destroy()
+
+    def enterLevel1(self, level=None):
+        if level is None:
+            self.drop_warm()
+            level = Level1(self, self.base)
+            level.load()
+        else:
+            level.start()
+        self.level1 = level
 
     def exitLevel1(self):
-        self.level1.destroy()
+        self.keep_warm(self.level1)
 
-    def enterLevel2(self):
-        self.level2 = Level2(self, self.base)
+    def enterLevel2(self, level=None):
+        if level is None:
+            self.drop_warm()
+            level = Level2(self, self.base)
+            level.load()
+        else:
+            level.start()
+        self.level2 = level
 
     def exitLevel2(self):
-        self.level2.destroy()
+        self.keep_warm(self.level2)
 
     def enterCredits(self):
         self.credits = Credits(self)
@@ -272,7 +2048,7 @@ class MainMenu:
         )
         self.title.setTransparency(TransparencyAttrib.MAlpha)
         self.buttons = [
-            make_button("NEW GAME", lambda: fsm.request("Level1"), (0, 0, -0.2)),
+            make_button("NEW GAME", lambda: fsm.play(Level1), (0, 0, -0.2)),
             make_button("HOW TO PLAY", lambda: fsm.request("HowToPlay"), (0, 0, -0.39)),
             make_button("CREDITS", lambda: fsm.request("Credits"), (0, 0, -0.57)),
             make_button("QUIT", sys.exit, (0, 0, -0.75)),
@@ -326,7 +2102,7 @@ class DeadScreen:
             "BACK TO MENU", lambda: fsm.request("MainMenu"), (0, 0, -0.6)
         )
         self.again_button = make_button(
-            "PLAY AGAIN", lambda: fsm.request("Level1"), (0, 0, -0.8)
+            "PLAY AGAIN", lambda: fsm.play(Level1), (0, 0, -0.8)
         )
 
     def destroy(self):
@@ -335,20 +2111,188 @@ class DeadScreen:
         self.again_button.destroy()
 
 
+class LoadingScreen:
+    def __init__(self, fsm, level_class):
+        self.fsm = fsm
+        self.base = fsm.base
+        self.text = OnscreenText("LOADING...", fg=(1, 1, 1, 1), pos=(0, 0.1))
+        self.stage_text = OnscreenText(
+            "Loading assets", fg=(1, 1, 1, 1), pos=(0, -0.25), scale=0.05, mayChange=True
+        )
+        self.bar = HealthBar()
+        self.bar.reparent_to(self.base.aspect2d)
+        self.bar.setScale(1, 1, 0.5)
+        self.bar.setPos(0, 0, -0.1)
+        self.bar.setHealth(0)
+        # The level is built under the loading screen; don't draw it yet.
+        if self.base.camNode:
+            self.base.camNode.setActive(False)
+
+        self.level = level_class(fsm, self.base)
+        self.stages = None
+        self.job = None
+        self.job_error = None
+        models, actors, sounds = level_class.assets()
+        self.total = len(models) + len(actors) + len(sounds)
+        self.loaded = 0
+        self.requests = self.base.assets.preload(models, actors, sounds, self.asset_loaded)
+        self.task = self.base.task_mgr.add(self.update_task, "loading_task")
+
+    def asset_loaded(self, _path):
+        self.loaded += 1
+        self.bar.setHealth(0.5 * self.loaded / self.total)
+
+    def run_job(self, job):
+        try:
+            job()
+        except Exception as e:
+            self.job_error = e
+        self.job = None
+
+    def update_task(self, task):
+        if self.loaded < self.total or self.job:
+            return task.cont
+        if self.job_error:
+            raise self.job_error
+        if self.stages is None:
+            self.stages = self.level.build()
+        stage = next(self.stages, None)
+        if stage is None:
+            level, self.level = self.level, None
+            self.fsm.request(type(level).__name__, level)
+            return task.done
+        self.stage_text.setText(stage[0])
+        self.bar.setHealth(0.5 + 0.5 * stage[1])
+        if len(stage) == 3:
+            self.job = stage[2]
+            self.base.task_mgr.add(
+                self.run_job, "loading_job", extraArgs=[self.job], taskChain="loading"
+            )
+        return task.cont
+
+    def destroy(self):
+        # The task holds a bound method of ours, so drop it to break the cycle.
+        self.task.remove()
+        self.task = None
+        for request in self.requests:
+            request.cancel()
+        if self.base.camNode:
+            self.base.camNode.setActive(True)
+        self.text.destroy()
+        self.stage_text.destroy()
+        self.bar.remove_node()
+
+
+class LevelFile:
+    # A level description: terrain, player start, props, an optional vehicle
+    # that wins the level once every alien is dead, and groups of alien
+    # spawns. Parsed once per path.
+    cache = {}
+    masks = {
+        "ground": ground_mask,
+        "wall": wall_mask,
+        "rover": rover_mask,
+        "spaceship": spaceship_mask,
+    }
+
+    def __init__(self, path):
+        with open(path) as f:
+            data = json.load(f)
+        self.path = path
+        self.heightmap = data["heightmap"]
+        self.height_scale = data.get("height_scale", 20)
+        self.player = tuple(data["player"])
+        self.props = data.get("props", [])
+        self.vehicle = data.get("vehicle")
+        aliens = data["aliens"]
+        self.alien_model = aliens["model"]
+        self.alien_hp = aliens.get("hp", 100)
+        self.fire_interval = aliens["fire_interval"]
+        self.groups = aliens["groups"]
+        self.streaming = data.get("streaming", {})
+        props = self.props + ([self.vehicle] if self.vehicle else [])
+        self.models = tuple(sorted({prop["model"] for prop in props}))
+        self.actors = (self.alien_model,)
+
+    @classmethod
+    def load(cls, path):
+        if path not in cls.cache:
+            cls.cache[path] = cls(path)
+        return cls.cache[path]
+
+    def collide_mask(self, names):
+        mask = BitMask32.allOff()
+        for name in names:
+            mask |= self.masks[name]
+        return mask
+
+    def spawn_points(self, size_x, size_y):
+        # Unseeded scatter groups draw from the level's random state.
+        xs = []
+        ys = []
+        for group in self.groups:
+            kind = group["kind"]
+            if kind == "scatter":
+                lo, inset = group["inset"]
+                rng = random.Random(group["seed"]) if "seed" in group else random
+                for _ in range(group["count"]):
+                    xs.append(rng.randint(lo, size_x - inset))
+                    ys.append(rng.randint(lo, size_y - inset))
+            elif kind == "ring":
+                (cx, cy), n = group["centre"], group["count"]
+                angles = 2 * math.pi / n * np.arange(n)
+                xs.extend((cx + group["radius"] * np.cos(angles)).tolist())
+                ys.extend((cy + group["radius"] * np.sin(angles)).tolist())
+            elif kind == "points":
+                for x, y in group["points"]:
+                    xs.append(x)
+                    ys.append(y)
+            else:
+                raise ValueError(f"{self.path}: unknown spawn group {kind!r}")
+        return np.array(xs, dtype=np.float32), np.array(ys, dtype=np.float32)
+
+
 class LevelBase:
+    notify = directNotify.newCategory("Level")
+    level_file = None
+
+    models = ("assets/models/gun.gltf", "assets/models/ball.bam")
+    actors = ("assets/models/player.bam",)
+    sounds = ("assets/sfx/gun.mp3", "assets/sfx/hurt.mp3")
+
     def __init__(self, fsm, base):
         self.base = base
         self.fsm = fsm
-
+        self.layout = LevelFile.load(self.level_file)
+        self.asset_refs = []
+        self.initial = None
+        self.checkpoint = None
+
+    @classmethod
+    def assets(cls):
+        layout = LevelFile.load(cls.level_file)
+        return cls.models + layout.models, cls.actors + layout.actors, cls.sounds
+
+    def load(self):
+        for stage in self.build():
+            if len(stage) == 3:
+                stage[2]()
+        self.start()
+
+    def build(self):
+        # Yields (label, progress) after each stage, or (label, progress, job)
+        # when the next stage needs job() to have run, possibly off-thread.
+        base = self.base
         self.center = None
         self.set_center()
 
         self.mouse_sensitivity = 20
 
+        self.root = base.render.attachNewNode(type(self).__name__)
         expfog = Fog("scene-wide-fog")
         expfog.setColor(*atmosphere_col)
         expfog.setExpDensity(0.002)
-        base.render.setFog(expfog)
+        self.root.setFog(expfog)
 
         ambientLight = AmbientLight("ambientLight")
         ambientLight.setColor(Vec4(0.6, 0.6, 0.6, 1))
@@ -356,140 +2300,495 @@ class LevelBase:
         directionalLight.setDirection(Vec3(0, -10, -10))
         directionalLight.setColor(Vec4(1, 1, 1, 1))
         directionalLight.setSpecularColor(Vec4(1, 1, 1, 1))
-        base.render.setLight(base.render.attachNewNode(ambientLight))
-        base.render.setLight(base.render.attachNewNode(directionalLight))
+        self.root.setLight(self.root.attachNewNode(ambientLight))
+        self.root.setLight(self.root.attachNewNode(directionalLight))
 
-        base.cTrav = CollisionTraverser()
-        base.cTrav.setRespectPrevTransform(True)
+        self.seed = base.replay.seed if base.replay else random.randrange(2**32)
+        random.seed(self.seed)
+        self.input = PlayerInput(base)
+
+        # Traversed as a simulation step rather than by ShowBase every frame.
+        self.cTrav = CollisionTraverser()
+        self.cTrav.setRespectPrevTransform(True)
 
         player_node = NodePath("player_node")
-        player_node.reparent_to(base.render)
-        self.player = Player(player_node, base.cTrav, base, self.fsm)
-        self.player.node.set_pos(23, 50, 0)
+        player_node.reparent_to(self.root)
+        self.player = Player(
+            player_node,
+            self.cTrav,
+            base,
+            self.fsm,
+            self.load_actor("assets/models/player.bam"),
+        )
+        self.player.node.set_pos(*self.layout.player)
         gun_node = NodePath("gun_node")
-        self.gun = Gun(gun_node, self.base.loader.loadModel("assets/models/gun.gltf"))
+        self.gun = Gun(gun_node, self.load_model("assets/models/gun.gltf"))
         self.gun.node.set_h(90)
         self.gun.node.set_r(-5)
         self.gun.node.set_pos(Vec3(0.3, 2, -0.4))
         self.gun.node.reparent_to(self.player.camera)
-        self.enemy_bullet_hit_queue = CollisionHandlerQueue()
-
-        self.terrain = GeoMipTerrain("terrain")
-        # self.terrain.setBruteforce(True)
-        self.terrain.setHeightfield("assets/textures/Heightmap.png")
-        img = PNMImage(257, 257, 3)
-        img.fillVal(163, 69, 41)
-        self.terrain.set_color_map(img)
-        self.terrain.set_focal_point(self.player.camera)
+
+        yield "Generating terrain", 0.1, self.generate_terrain
+        # GeoMipTerrain isn't safe to generate off the main thread while the
+        # loading screen renders, so only the heightfields are read in the job.
         self.terrain.generate()
-        self.terrain_mesh = self.terrain.get_root()
-        self.terrain_mesh.setSz(20)
-        self.terrain_mesh.reparentTo(base.render)
-        self.terrain_mesh.setCollideMask(ground_mask)
+        self.terrain_mesh.reparentTo(self.root)
 
-        self.num_aliens = None
+        self.projectiles = ProjectileSystem(
+            self.load_model("assets/models/ball.bam"),
+            self.root,
+            self.heightfield.heights_at,
+        )
+        self.entities = EntityStore()
+        self.hitscan = Hitscan(self.root, self.heightfield, enemy_mask | wall_mask)
+        self.triggers = TriggerSystem(self.player.node)
+        self.ai = AISystem(self.player, self.entities)
+
+        # Distances here are in world units, but the player camera is scaled
+        # with the player, and fog density applies to camera-space distance.
+        # Fog reaches 1/256 visibility at ln(256) / density in camera units,
+        # so past that nothing further is drawn.
+        cam_scale = self.player.camera.getNetTransform().getScale().x
+        fog_distance = math.log(256) / expfog.getExpDensity() * cam_scale
+        self.view_distance = min(self.terrain.radius, fog_distance)
+        self.player.cam.getLens().setFar(self.view_distance / cam_scale)
+        self.cells = SceneCells(
+            base, self.root, self.player.node, far_distance=self.view_distance
+        )
+        self.animation = AnimationLOD(
+            base,
+            self.entities,
+            self.player.node,
+            "CharacterArmature|Shoot",
+            far_distance=self.view_distance / 4,
+            # Impostors are snapshots, so they need something to render with.
+            impostors=ImpostorLayer(base, self.root) if base.win else None,
+        )
+
+        xs, ys = self.layout.spawn_points(self.terrain.size_x, self.terrain.size_y)
+        # Heights are looked up once here, never when a region activates.
+        points = np.stack([xs, ys, self.heightfield.heights_at(xs, ys)], axis=1)
+        self.spawner = Spawner(
+            self.entities,
+            self.player.node,
+            points,
+            self.layout.alien_hp,
+            self.spawn_alien,
+            self.retire_alien,
+            **self.layout.streaming,
+        )
+        self.alien_pool = []
+        self.num_aliens = len(points)
+        yield "Building HUD", 0.3
+
+        self.hud = Hud(base)
+        self.hud.root.hide()
+        self.player.hp_bar.reparent_to(self.hud.root)
 
         self.aliens_killed = 0
         self.aliens_killed_bar = HealthBar()
         self.aliens_killed_bar.setHealth(0)
-        self.aliens_killed_bar.reparent_to(base.aspect2d)
+        self.aliens_killed_bar.reparent_to(self.hud.root)
         self.aliens_killed_bar.setPos(1.1, 0, 0.9)
         self.aliens_killed_bar.setScale(1, 0, 0.5)
         self.ak_text_n = TextNode("aliens_killed_text_node")
         self.ak_text_np = self.aliens_killed_bar.attachNewNode(self.ak_text_n)
         self.ak_text_np.set_scale(0.1, 1, 0.2)
         self.ak_text_np.set_pos((-0.1, 0, -0.05))
-        self.alien_im = OnscreenImage("assets/alien.png", pos=(-0.4, 0, 0))
-        self.alien_im.setScale(0.1)
-        self.alien_im.setTransparency(TransparencyAttrib.MAlpha)
-        self.alien_im.reparent_to(self.aliens_killed_bar)
-
-        self.crosshair = OnscreenImage(image="assets/textures/cross.png", pos=(0, 0, 0))
-        self.crosshair.setTransparency(TransparencyAttrib.MAlpha)
-        self.crosshair.setScale(0.1)
-
-        self.gun_sfx = self.base.loader.loadSfx("assets/sfx/gun.mp3")
-        self.hurt_sfx = self.base.loader.loadSfx("assets/sfx/hurt.mp3")
-
-        base.task_mgr.add(self.mouse_look_task, "mouse_look_task")
-        base.task_mgr.add(self.player_movement_task, "player_movement_task")
-        base.task_mgr.add(self.check_enemy_bullets_task, "check_enemy_bullets_task")
-        base.task_mgr.add(self.update_terrain_task, "update_terrain_task")
-        base.task_mgr.add(self.update_timer_task, "update_timer_task")
-        base.task_mgr.doMethodLater(0.25, self.fire_bullet_task, "fire_bullet_task")
-
-        self.minimap_pos = Vec3(-1.4, 0, 0.7)
-        self.minimap = OnscreenImage(
-            image="assets/textures/minimap.png",
-            scale=(0.25, 1, 0.25),
-            pos=self.minimap_pos,
-        )
-        a = self.minimap.getTightBounds()
-        self.minimap_rad = (a[1].x - a[0].x) / 2
-        self.minimap.setTransparency(TransparencyAttrib.MAlpha)
-
-        self.pmm_image = OnscreenImage(
-            image="assets/textures/playerhead.png",
-            pos=self.minimap_pos,
-            scale=(0.015, 1, 0.015),
-        )
-        self.pmm_image.setTransparency(TransparencyAttrib.MAlpha)
-
-        self.timer = OnscreenText("00:00", mayChange=True, pos=(0, -0.85))
-        self.timer.reparent_to(self.base.aspect2d)
-        self.start_time = datetime.datetime.now()
+        self.hud.image("assets/alien.png", (0.7, 0, 0.9), (0.1, 1, 0.05))
+
+        self.hud.image("assets/textures/cross.png", (0, 0, 0), 0.1)
+
+        self.voices = SoundPool(
+            base.sfxManagerList[0], self.player.node, self.ai.engage_radius
+        )
+        # Held for as long as the level, so the voices share their samples.
+        for path in self.sounds:
+            self.load_sfx(path)
+        self.voices.add_category("gun", "assets/sfx/gun.mp3", 3)
+        self.voices.add_category("hurt", "assets/sfx/hurt.mp3", 2)
+        self.voices.add_category("alien", "assets/sfx/gun.mp3", 6, 0.6, 0.8)
+
+        self.fire_cooldown = 0.25
+        self.next_shot = 0.0
+        self.checksum_interval = 60
+
+        self.minimap = Minimap(base, self.hud, Vec3(-1.4, 0, 0.7), self.player.node)
+        self.minimap.add_category(
+            "enemy",
+            "assets/textures/enemy.png",
+            lambda: self.entities.pos[self.entities.flags != 0],
+        )
+
+        self.timer = OnscreenText(
+            "00:00", mayChange=True, pos=(0, -0.85), parent=self.hud.root
+        )
         self.time_elapsed = None
 
+        self.sim = Simulation(base)
+        self.sim.add_system("Input", self.input_step)
+        self.sim.add_system("Movement", self.player_movement_step)
+        self.sim.add_system("Collisions", self.collision_step)
+        self.sim.add_system("Projectiles", self.enemy_bullets_step)
+        self.sim.add_system("Spawner", self.spawner_step)
+        self.sim.add_system("AI", self.ai_step)
+        self.sim.add_system("Triggers", self.triggers_step)
+        self.sim.add_system("Hitscan", self.fire_bullet_step)
+        self.sim.add_system("Checksum", self.checksum_step)
+        self.sim.add_renderer(self.projectiles.sync)
         self.props = WindowProperties()
+        yield "Placing objects", 0.5
+
+        for prop in self.layout.props:
+            self.place_prop(prop)
+        self.vehicle = None
+        self.vehicle_message = None
+        if self.layout.vehicle:
+            vehicle = self.layout.vehicle
+            self.vehicle = self.place_prop(vehicle)
+            self.triggers.add_sphere(
+                vehicle["name"],
+                self.vehicle.get_pos(),
+                vehicle["radius"],
+                "vehicle_enter",
+                "vehicle_exit",
+            )
+        yield "Spawning aliens", 0.7
+
+        self.spawner.update(force=True)
+        self.hud.update("kills", self.aliens_killed, self.show_kills)
+
+    def generate_terrain(self):
+        self.terrain = TerrainPager(
+            "terrain", self.layout.heightmap, self.player.camera, bake=self.base.bake
+        )
+        self.terrain_mesh = self.terrain.root
+        self.terrain_mesh.setSz(self.layout.height_scale)
+        self.heightfield = Heightfield(
+            self.layout.heightmap, self.terrain_mesh.get_sz(), self.base.bake
+        )
+
+    def place_prop(self, prop):
+        node = self.load_model(prop["model"])
+        node.reparent_to(self.root)
+        x, y = prop["pos"]
+        node.set_pos(x, y, self.heightfield.height_at(x, y))
+        node.set_scale(prop.get("scale", 1))
+        node.set_h(prop.get("h", 0))
+        if "collide" in prop:
+            attach_box_proxy(node, self.layout.collide_mask(prop["collide"]))
+            self.projectiles.add_blocker_node(node)
+        self.cells.add_static(node, keep=True)
+        if "minimap" in prop:
+            self.minimap.add_category(prop["name"], prop["minimap"], node.get_pos)
+        return node
+
+    def spawn_alien(self, i):
+        if self.alien_pool:
+            alien = self.alien_pool.pop()
+        else:
+            alien = Alien(
+                self.entities,
+                self.root.attachNewNode("alien_node"),
+                self.player,
+                self.projectiles,
+                self.load_actor(self.layout.alien_model),
+            )
+        alien.spawn(i, self.entities.pos[i], self.entities.hp[i])
+        self.cells.add(alien.node)
+        self.ai.add(alien, self.layout.fire_interval)
+        self.animation.add(alien)
+
+    def retire_alien(self, i):
+        alien = self.entities.handles[i]
+        self.ai.remove(alien)
+        self.animation.remove(alien)
+        self.entities.despawn(i)
+        alien.node.stash()
+        self.alien_pool.append(alien)
+
+    def vehicle_enter(self, _):
+        if self.aliens_killed < self.num_aliens:
+            self.vehicle_message = OnscreenText(self.layout.vehicle["locked"])
+        else:
+            self.vehicle_message = OnscreenText(self.layout.vehicle["ready"])
+            self.base.acceptOnce("e", lambda: self.fsm.request("WinScreen", self.time_elapsed))
+        self.vehicle_message.set_pos(0, 0, -0.3)
+
+    def vehicle_exit(self, _):
+        self.base.ignore("e")
+        if self.vehicle_message:
+            self.vehicle_message.destroy()
+            self.vehicle_message = None
+
+    def start(self):
+        base = self.base
+        if self.initial is None:
+            self.hud.flatten()
+            self.cells.flatten()
+            self.sim.interpolate(self.player.node)
+            self.initial = self.snapshot()
+        self.root.unstash()
+        self.hud.root.show()
+
+        if base.replay:
+            base.replay.rewind()
+            self.input.replay = base.replay
+        elif base.record_path:
+            path = base.next_record_path()
+            self.notify.info(f"recording input to {path}")
+            self.input.recorder = InputRecorder(path, type(self).__name__, self.seed)
+        self.sim.start()
+        self.minimap.start()
+        self.cells.start()
+        self.animation.start()
+
+        # Look runs every frame; the rest can be deferred to stay on budget.
+        self.jobs = [
+            base.task_mgr.add(
+                base.timings.wrap("MouseLook", self.mouse_look_task),
+                "mouse_look_task",
+                sort=-10,
+            ),
+            base.scheduler.add("Terrain", self.terrain.update, priority=0, rate=30),
+            base.scheduler.add("HUD", self.update_timer, priority=4, rate=10),
+        ]
+
         self.props.setCursorHidden(True)
-        base.win.requestProperties(self.props)
+        base.request_properties(self.props)
 
         base.accept("aspectRatioChanged", self.set_center)
         base.accept("escape", lambda: self.fsm.request("MainMenu"))
-
-        dr = base.camNode.getDisplayRegion(0)
-        dr.setCamera(self.player.camera)
+        if not (self.input.recorder or self.input.replay):
+            # Checkpoints are not in the input stream, so loading one would
+            # make a recording diverge on replay.
+            base.accept("f5", self.save_checkpoint)
+            base.accept("f9", self.load_checkpoint)
+        if self.vehicle:
+            base.accept("vehicle_enter", self.vehicle_enter)
+            base.accept("vehicle_exit", self.vehicle_exit)
+
+        if base.camNode:
+            base.camNode.getDisplayRegion(0).setCamera(self.player.camera)
+
+    def suspend(self):
+        # Stops the level but keeps it built, so it can be reset and
+        # started again without a reload.
+        base = self.base
+        self.sim.stop()
+        self.minimap.stop()
+        self.cells.stop()
+        self.animation.stop()
+        self.voices.stop()
+        for job in self.jobs:
+            job.remove()
+        self.jobs.clear()
+        self.vehicle_exit(None)
+        for event in (
+            "aspectRatioChanged",
+            "escape",
+            "f5",
+            "f9",
+            "vehicle_enter",
+            "vehicle_exit",
+        ):
+            base.ignore(event)
+        if self.input.recorder:
+            self.input.recorder.close()
+        self.input.recorder = self.input.replay = None
+        if base.camNode:
+            self.player.cam.getDisplayRegion(0).setCamera(base.cam)
+        self.props.setCursorHidden(False)
+        base.request_properties(self.props)
+        self.hud.root.hide()
+        self.root.stash()
+
+    def reset(self):
+        self.restore(self.initial)
+
+    def save_checkpoint(self):
+        self.checkpoint = self.snapshot()
+
+    def load_checkpoint(self):
+        if self.checkpoint is not None:
+            self.restore(self.checkpoint)
+
+    def snapshot(self):
+        player = self.player
+        return {
+            "player": (
+                player.node.get_pos(),
+                player.node.get_hpr(),
+                player.rot_h,
+                player.rot_v,
+                player.hp,
+                Vec3(player.jump_velocity),
+                player.grounded,
+            ),
+            "aliens": [
+                (i, handle.node.get_hpr())
+                for i, handle in enumerate(self.entities.handles)
+                if handle is not None
+            ],
+            "spawner": self.spawner.snapshot(),
+            "entities": self.entities.snapshot(),
+            "projectiles": self.projectiles.snapshot(),
+            "sim": self.sim.snapshot(),
+            "aliens_killed": self.aliens_killed,
+            "next_shot": self.next_shot,
+            "random": random.getstate(),
+        }
+
+    def restore(self, snapshot):
+        player = self.player
+        pos, hpr, player.rot_h, player.rot_v, player.hp, jump, player.grounded = snapshot[
+            "player"
+        ]
+        player.node.set_pos(pos)
+        player.node.set_hpr(hpr)
+        player.camera.set_p(min(90, max(-90, player.rot_v)))
+        player.jump_velocity = Vec3(jump)
+        player.hp_bar.setHealth(player.hp / 100)
+        self.input.pending = [0.0, 0.0]
+
+        self.spawner.restore(snapshot["spawner"], [i for i, _hpr in snapshot["aliens"]])
+        self.entities.restore(snapshot["entities"])
+        for i, hpr in snapshot["aliens"]:
+            alien = self.entities.handles[i]
+            alien.node.set_pos(*self.entities.pos[i])
+            alien.node.set_hpr(hpr)
+            if self.entities.flags[i]:
+                alien.node.unstash()
+            else:
+                alien.node.stash()
+            if self.entities.flags[i] & EntityStore.ALIVE:
+                alien.actor.loop("CharacterArmature|Shoot")
+                self.ai.moved(alien)
+            else:
+                death = "CharacterArmature|Death"
+                alien.actor.pose(death, alien.actor.getNumFrames(death) - 1)
+                self.ai.remove(alien)
+        self.animation.reset()
+        self.projectiles.restore(snapshot["projectiles"])
+        self.sim.restore(snapshot["sim"])
+        self.ai.reset(self.sim.time)
+        self.triggers.reset()
+
+        self.vehicle_exit(None)
+
+        self.aliens_killed = snapshot["aliens_killed"]
+        self.next_shot = snapshot["next_shot"]
+        random.setstate(snapshot["random"])
+        self.hud.update("kills", self.aliens_killed, self.show_kills)
+        self.update_timer()
+
+    def load_model(self, path):
+        self.asset_refs.append(path)
+        return self.base.assets.load_model(path)
+
+    def load_actor(self, path):
+        self.asset_refs.append(path)
+        return self.base.assets.load_actor(path)
+
+    def load_sfx(self, path):
+        self.asset_refs.append(path)
+        return self.base.assets.acquire_sound(path)
 
     def set_center(self):
-        self.center = (self.base.win.getXSize() // 2, self.base.win.getYSize() // 2)
+        if self.base.win:
+            self.center = (self.base.win.getXSize() // 2, self.base.win.getYSize() // 2)
+        else:
+            self.center = (0, 0)
+
+    def input_step(self, _dt):
+        if not self.input.sample():
+            self.sim.speed = 0
+            self.notify.info(
+                f"replay finished after {self.input.replay.steps} steps, "
+                f"{self.input.replay.checked} checksums, "
+                f"diverged at {self.input.replay.diverged_at}"
+            )
 
-    def update_terrain_task(self, _task):
-        self.terrain.update()
-        return Task.cont
+    def collision_step(self, _dt):
+        self.cTrav.traverse(self.root)
+
+    def checksum_step(self, _dt):
+        if (self.sim.steps + 1) % self.checksum_interval:
+            return
+        checksum = self.state_checksum()
+        if self.input.recorder:
+            self.input.recorder.write_checksum(checksum)
+        elif self.input.replay:
+            self.input.replay.check(checksum)
+
+    def state_checksum(self):
+        player = np.array(
+            [
+                *self.player.node.get_pos(),
+                self.player.rot_h,
+                self.player.rot_v,
+                self.player.hp,
+                self.aliens_killed,
+            ],
+            dtype=np.float32,
+        )
+        checksum = zlib.crc32(player.tobytes())
+        checksum = zlib.crc32(self.entities.hp.tobytes(), checksum)
+        checksum = zlib.crc32(self.entities.flags.tobytes(), checksum)
+        checksum = zlib.crc32(self.entities.pos.tobytes(), checksum)
+        alive = self.projectiles.alive
+        return zlib.crc32(self.projectiles.pos[alive].tobytes(), checksum)
+
+    def triggers_step(self, _dt):
+        self.triggers.update()
+
+    def spawner_step(self, _dt):
+        self.spawner.update()
+
+    def ai_step(self, _dt):
+        for i in self.ai.update(self.sim.time):
+            self.voices.play("alien", self.entities.pos[i])
 
     def mouse_look_task(self, _task):
-        if self.base.mouseWatcherNode.hasMouse():
-            mx = self.base.mouseWatcherNode.getMouseX()
-            my = self.base.mouseWatcherNode.getMouseY()
-            self.player.rot_h += -1 * self.mouse_sensitivity * mx
-            self.player.rot_v += self.mouse_sensitivity * my
-            self.rot_v = min(90, max(-90, self.player.rot_v))
-            self.player.node.set_hpr(self.player.rot_h, 0, 0)
-            self.player.camera.set_p(self.rot_v)
-            self.pmm_image.set_r(-self.player.rot_h)
-        self.base.win.movePointer(0, *self.center)
+        watcher = self.base.mouseWatcherNode
+        if not self.input.replay and watcher and watcher.hasMouse():
+            self.input.add_look(
+                -1 * self.mouse_sensitivity * watcher.getMouseX(),
+                self.mouse_sensitivity * watcher.getMouseY(),
+            )
+        dh, dv = self.input.pending
+        self.show_look(self.player.rot_h + dh, self.player.rot_v + dv)
+        if self.base.has_window():
+            self.base.win.movePointer(0, *self.center)
         return Task.cont
 
-    def player_movement_task(self, _task):
+    def show_look(self, h, v):
+        self.player.node.set_hpr(h, 0, 0)
+        self.player.camera.set_p(min(90, max(-90, v)))
+        self.minimap.player_image.set_r(-h)
+
+    def player_movement_step(self, dt):
+        dh, dv = self.input.look
+        self.player.rot_h += dh
+        self.player.rot_v += dv
+        self.show_look(self.player.rot_h, self.player.rot_v)
+
         velocity = Vec3(0, 0, 0)
-        dt = globalClock.getDt()
         speed = Vec3(100, 40, 30)  # front, back, sideways
         x, y, _z = self.player.node.get_pos()
-        self.player.node.setX(min(max(1, x), 255))
-        self.player.node.setY(min(max(1, y), 255))
-        terrain_height = (
-            self.terrain.get_elevation(x, y) * self.terrain_mesh.get_sz() + 2
-        )
+        self.player.node.setX(min(max(1, x), self.terrain.size_x - 2))
+        self.player.node.setY(min(max(1, y), self.terrain.size_y - 2))
+        terrain_height = self.heightfield.height_at(x, y) + 2
         if self.player.grounded:
-            if self.base.mouseWatcherNode.is_button_down(KeyboardButton.ascii_key("w")):
+            if self.input.down("forward"):
                 velocity.y = speed.x * dt
-            if self.base.mouseWatcherNode.is_button_down(KeyboardButton.ascii_key("s")):
+            if self.input.down("back"):
                 velocity.y = -speed.y * dt
-            if self.base.mouseWatcherNode.is_button_down(KeyboardButton.ascii_key("d")):
+            if self.input.down("right"):
                 velocity.x = speed.z * dt
-            if self.base.mouseWatcherNode.is_button_down(KeyboardButton.ascii_key("a")):
+            if self.input.down("left"):
                 velocity.x = -speed.z * dt
-            if self.base.mouseWatcherNode.is_button_down(KeyboardButton.space()):
+            if self.input.down("jump"):
                 self.player.jump_velocity = Vec3(
                     velocity.x, velocity.y, math.sqrt(20 * -2 * -9.8)
                 )
@@ -506,241 +2805,94 @@ class LevelBase:
             self.player.node.setZ(terrain_height)
             self.player.grounded = True
             self.player.jump_velocity = Vec3(-1, -1, -1)
-        return Task.cont
-
-    def fire_bullet_task(self, task):
-        if not self.base.mouseWatcherNode.is_button_down(MouseButton.one()):
-            return task.cont
-        self.gun_sfx.play()
-        for entry in self.player.gun_queue.entries:
-            alien = entry.getIntoNodePath().getNetPythonTag("alien")
-            if not alien:
-                continue
 
-            def cb(alien=alien):
-                alien.node.remove_node()
-                self.base.task_mgr.remove(f"alien{id(alien)}_update")
-
-            if alien.take_damage(5):
-                self.aliens_killed += 1
-                self.aliens_killed_bar.setHealth(self.aliens_killed / self.num_aliens)
-                self.ak_text_n.set_text(f"{self.aliens_killed}/{self.num_aliens}")
-                alien.actor.play("CharacterArmature|Death")
-                self.base.task_mgr.doMethodLater(
-                    2, cb, "dead_alien_remove", extraArgs=[]
-                )
-        return task.again
-
-    def update_timer_task(self, task):
-        delta = datetime.datetime.now() - self.start_time
-        minutes, seconds = divmod(round(delta.total_seconds()), 60)
+    def fire_bullet_step(self, _dt):
+        if self.sim.time < self.next_shot:
+            return
+        if not self.input.down("fire"):
+            return
+        self.next_shot = self.sim.time + self.fire_cooldown
+        self.voices.play("gun")
+        origin = self.base.render.get_relative_point(self.player.camera, Point3(0, 1, 1))
+        direction = self.base.render.get_relative_vector(self.player.camera, Vec3(0, 1, 0))
+        into_node, _point, _dist = self.hitscan.query(origin, direction)
+        i = self.entities.id_of(into_node)
+        if i is not None:
+            self.entities.apply_damage([i], 5)
+        for i in self.entities.collect_dead():
+            alien = self.entities.handles[i]
+
+            def cb(i=i):
+                # Kept in the store so a reset or checkpoint can revive it,
+                # unless its region was retired meanwhile.
+                self.entities.flags[i] = 0
+                alien = self.entities.handles[i]
+                if alien is not None:
+                    alien.node.stash()
+                    self.ai.remove(alien)
+
+            self.aliens_killed += 1
+            self.hud.update("kills", self.aliens_killed, self.show_kills)
+            self.animation.wake(alien)
+            alien.actor.play("CharacterArmature|Death")
+            self.sim.call_later(2, cb)
+
+    def update_timer(self):
+        minutes, seconds = divmod(round(self.sim.time), 60)
         self.time_elapsed = f"{minutes:>02}:{seconds:>02}"
-        self.timer.setText(self.time_elapsed)
-        return task.cont
-
-    def check_enemy_bullets_task(self, task):
-        for entry in self.enemy_bullet_hit_queue.entries:
-            bullet = entry.getFromNodePath().getPythonTag("bullet")
-            bullet.remove_node()
-            self.base.task_mgr.remove(f"bullet{id(bullet)}_update")
-            if entry.getIntoNodePath().findNetTag("player"):
-                self.hurt_sfx.play()
-                self.player.take_damage(1)
-        return task.cont
+        self.hud.update("timer", self.time_elapsed, self.timer.setText)
+
+    def show_kills(self, kills):
+        self.aliens_killed_bar.setHealth(kills / max(self.num_aliens, 1))
+        self.ak_text_n.set_text(f"{kills}/{self.num_aliens}")
+
+    def enemy_bullets_step(self, dt):
+        pos = self.player.node.get_pos()
+        hits = self.projectiles.step(
+            dt,
+            pos + Vec3(0, 0, self.player.capsule_radius),
+            pos + Vec3(0, 0, self.player.capsule_height - self.player.capsule_radius),
+            self.player.capsule_radius,
+        )
+        for _ in range(hits):
+            self.voices.play("hurt")
+            self.player.take_damage(1)
+            if self.player.hp <= 0:
+                break
 
     def destroy(self):
-        self.player.camera.node().getDisplayRegion(0).setCamera(self.base.cam)
-        self.base.render.node().removeAllChildren()
-        self.base.render.clearLight()
-        self.player.hp_bar.remove_node()
-        self.aliens_killed_bar.remove_node()
-        self.timer.remove_node()
-        self.base.task_mgr.remove("mouse_look_task")
-        self.base.task_mgr.remove("player_movement_task")
-        self.base.task_mgr.remove("check_enemy_bullets_task")
-        self.base.task_mgr.remove("fire_bullet_task")
-        self.base.task_mgr.remove("draw_aliens_mipmap_task")
-        self.base.task_mgr.remove("update_timer_task")
-        self.base.task_mgr.removeTasksMatching("bullet*")
-        self.base.task_mgr.removeTasksMatching("alien*")
-        self.crosshair.destroy()
-        self.props.setCursorHidden(False)
-        self.base.win.requestProperties(self.props)
+        if self.sim.running:
+            self.suspend()
+        self.sim.destroy()
+        self.projectiles.destroy()
+        self.terrain.destroy()
+        # Actors and a node lit by its own children are reference cycles
+        # in Panda, so removing the root alone would not free them.
+        self.player.actor.cleanup()
+        for alien in self.entities.handles + self.alien_pool:
+            if alien is not None:
+                alien.actor.cleanup()
+        self.root.clearLight()
+        self.root.remove_node()
+        self.hud.destroy()
+        self.ai.destroy()
+        self.animation.destroy()
+        self.cells.destroy()
+        self.voices.destroy()
+        self.minimap.destroy()
+        if self.vehicle_message:
+            self.vehicle_message.destroy()
+        for path in self.asset_refs:
+            self.base.assets.release(path)
+        self.asset_refs.clear()
 
 
 class Level1(LevelBase):
-    def __init__(self, fsm, base):
-        super().__init__(fsm, base)
-        self.rover_map_im = OnscreenImage("assets/textures/rover.png", scale=(0.02, 1, 0.02))
-        self.rover_map_im.setTransparency(TransparencyAttrib.MAlpha)
-        self.rover_map_im.hide()
-
-        self.rover = base.loader.load_model("assets/models/rover.bam")
-        self.rover.reparent_to(base.render)
-        self.rover.set_pos(
-            20, 50, self.terrain.get_elevation(20, 50) * self.terrain_mesh.get_sz()
-        )
-        self.rover.set_scale(0.3)
-        self.rover.setCollideMask(wall_mask | rover_mask)
-
-        self.rover_message = None
-
-        self.num_aliens = 10
-        self.aliens = []
-        self.imgs = []
-        for i in range(self.num_aliens):
-            self.imgs.append(
-                OnscreenImage(
-                    image="assets/textures/enemy.png",
-                    scale=(0.02, 1, 0.02),
-                )
-            )
-            self.imgs[i].setTransparency(TransparencyAttrib.MAlpha)
-            self.imgs[i].hide()
-
-        for i in range(self.num_aliens):
-            x = random.randint(5, 240)
-            y = random.randint(5, 240)
-            z = self.terrain.get_elevation(x, y) * self.terrain_mesh.get_sz()
-            al = NodePath(f"alien{i}_node")
-            self.aliens.append(al)
-            alien = Alien(
-                al,
-                Vec3(x, y, z),
-                self.player,
-                base.loader,
-                base.render,
-                base.task_mgr,
-                base.cTrav,
-                self.enemy_bullet_hit_queue,
-            )
-            alien.node.reparent_to(base.render)
-            alien.node.setCollideMask(enemy_mask)
-            alien.node.setPythonTag("alien", alien)
-            base.task_mgr.doMethodLater(
-                0.5, alien.update_task, f"alien{id(alien)}_update"
-            )
-        base.task_mgr.add(self.draw_aliens_mipmap_task, "draw_aliens_mipmap_task")
-        self.ak_text_n.set_text(f"{self.aliens_killed}/{self.num_aliens}")
-        base.accept("vehicle_enter", self.rover_enter)
-        base.accept("vehicle_exit", self.rover_exit)
-
-    def draw_aliens_mipmap_task(self, task):
-        ppos = self.player.node.get_pos()
-        for i, alien in enumerate(self.aliens):
-            if alien.is_empty():
-                self.imgs[i].hide()
-            else:
-                vec = Vec2(alien.getX(), alien.getY()) - Vec2(ppos.x, ppos.y)
-                dist = vec.length()
-                if dist <= 50:
-                    vn = vec.normalized()
-                    self.imgs[i].show()
-                    p = (vn * self.minimap_rad) * (dist / 50)
-                    self.imgs[i].set_pos(self.minimap_pos + Vec3(p.x, 0, p.y))
-                else:
-                    self.imgs[i].hide()
-        vec = Vec2(self.rover.getX(), self.rover.getY()) - Vec2(ppos.x, ppos.y)
-        dist = vec.length()
-        if dist <= 50:
-            vn = vec.normalized()
-            self.rover_map_im.show()
-            p = (vn * self.minimap_rad) * (dist / 50)
-            self.rover_map_im.set_pos(self.minimap_pos + Vec3(p.x, 0, p.y))
-        else:
-            self.rover_map_im.hide()
-        return task.cont
-
-    def rover_enter(self, _):
-        if (self.player.node.get_pos() - self.rover.get_pos()).length() > 5:
-            return
-        if self.aliens_killed < self.num_aliens:
-            self.rover_message = OnscreenText("Kill all aliens to use rover.")
-        else:
-            self.rover_message = OnscreenText("Press E to use rover.")
-            self.base.acceptOnce("e", lambda: self.fsm.request("WinScreen", self.time_elapsed))
-        self.rover_message.set_pos(0, 0, -0.3)
-
-    def rover_exit(self, _):
-        self.base.ignore("e")
-        if self.rover_message:
-            self.rover_message.destroy()
-
-    def destroy(self):
-        super().destroy()
-        if self.rover_message:
-            self.rover_message.destroy()
-        self.pmm_image.destroy()
-        self.minimap.destroy()
-        self.rover_map_im.destroy()
-        for im in self.imgs:
-            im.destroy()
+    level_file = "assets/levels/level1.json"
 
 
 class Level2(LevelBase):
-    def __init__(self, fsm, base):
-        super().__init__(fsm, base)
-        self.player.node.set_pos(8, -8, 1)
-        self.spaceship = base.loader.load_model("assets/models/spaceship.bam")
-        self.spaceship.reparent_to(base.render)
-        self.spaceship.set_pos(
-            40, 60, self.terrain.get_elevation(40, 60) * self.terrain_mesh.get_sz()
-        )
-        self.spaceship.set_scale(0.3)
-        self.spaceship.set_h(45)
-        self.spaceship.setCollideMask(wall_mask | spaceship_mask | ground_mask)
-        self.spaceship_message = None
-        base.accept("vehicle_enter", self.spaceship_enter)
-        base.accept("vehicle_exit", self.spaceship_exit)
-
-        alien_centre = Vec3(40, 60, 0)
-        alien_radius = 4
-        self.num_aliens = 15
-        for i in range(self.num_aliens):
-            x = alien_centre.x + alien_radius * math.cos(
-                2 * math.pi / self.num_aliens * i
-            )
-            y = alien_centre.y + alien_radius * math.sin(
-                2 * math.pi / self.num_aliens * i
-            )
-            z = self.terrain.get_elevation(x, y) * self.terrain_mesh.get_sz()
-            alien = Alien(
-                NodePath(f"alien{i}_node"),
-                Vec3(x, y, z),
-                self.player,
-                base.loader,
-                base.render,
-                base.task_mgr,
-                base.cTrav,
-                self.enemy_bullet_hit_queue,
-            )
-            alien.node.reparent_to(base.render)
-            alien.node.setCollideMask(enemy_mask)
-            alien.node.setPythonTag("alien", alien)
-            base.task_mgr.doMethodLater(
-                2, alien.update_task, f"alien{id(alien)}_update"
-            )
-        self.ak_text_n.set_text(f"{self.aliens_killed}/{self.num_aliens}")
-
-    def spaceship_enter(self, _):
-        if (self.player.node.get_pos() - self.spaceship.get_pos()).length() > 5:
-            return
-        if self.aliens_killed < self.num_aliens:
-            self.spaceship_message = OnscreenText("Kill all aliens to use spaceship.")
-        else:
-            self.spaceship_message = OnscreenText("Press E to use spaceship.")
-            self.base.acceptOnce("e", lambda: self.fsm.request("WinScreen"))
-        self.spaceship_message.set_pos(0, 0, -0.3)
-
-    def spaceship_exit(self, _):
-        self.base.ignore("e")
-        if self.spaceship_message:
-            self.spaceship_message.destroy()
-
-    def destroy(self):
-        super().destroy()
-        if self.spaceship_message:
-            self.spaceship_message.destroy()
+    level_file = "assets/levels/level2.json"
 
 
 def make_button(text, callback, pos):
@@ -759,6 +2911,16 @@ def make_button(text, callback, pos):
     )
 
 
+def attach_box_proxy(model, mask):
+    model.setCollideMask(BitMask32.allOff())
+    lo, hi = model.getTightBounds(model)
+    proxy = model.attachNewNode(CollisionNode(f"{model.get_name()}_proxy"))
+    proxy.node().addSolid(CollisionBox(lo, hi))
+    proxy.node().setIntoCollideMask(mask)
+    proxy.node().setFromCollideMask(0)
+    return proxy
+
+
 class Gun:
     def __init__(self, node, model):
         self.node = node
@@ -766,6 +2928,296 @@ class Gun:
         self.model.reparent_to(self.node)
 
 
+class TextureAtlas:
+    def __init__(self, paths, size=512, max_image_size=192, padding=2, bake=None):
+        self.paths = list(paths)
+        self.kind = kind = f"atlas{size}-{max_image_size}-{padding}"
+        baked = bake and bake.find(kind, ".txo", *paths)
+        if baked:
+            self.texture = TexturePool.loadTexture(baked)
+            with open(bake.find(kind, ".json", *paths)) as f:
+                self.uvs = {path: tuple(uv) for path, uv in json.load(f).items()}
+            return
+
+        images = {}
+        for path in paths:
+            image = PNMImage(Filename(path))
+            image.addAlpha()
+            largest = max(image.getXSize(), image.getYSize())
+            if largest > max_image_size:
+                scaled = PNMImage(
+                    max(1, image.getXSize() * max_image_size // largest),
+                    max(1, image.getYSize() * max_image_size // largest),
+                    4,
+                )
+                scaled.gaussianFilterFrom(1.0, image)
+                image = scaled
+            images[path] = image
+
+        atlas = PNMImage(size, size, 4)
+        atlas.fill(0, 0, 0)
+        atlas.alphaFill(0)
+        self.uvs = {}
+        x = y = shelf = 0
+        order = sorted(images, key=lambda p: images[p].getYSize(), reverse=True)
+        for path in order:
+            image = images[path]
+            w, h = image.getXSize(), image.getYSize()
+            if x + w > size:
+                x, y, shelf = 0, y + shelf + padding, 0
+            if y + h > size:
+                raise ValueError(f"{path} does not fit in a {size}x{size} atlas")
+            atlas.copySubImage(image, x, y)
+            # PNMImage rows run top down, texture v runs bottom up.
+            self.uvs[path] = (x / size, 1 - (y + h) / size, (x + w) / size, 1 - y / size)
+            x += w + padding
+            shelf = max(shelf, h)
+
+        self.texture = Texture("hud_atlas")
+        self.texture.load(atlas)
+        self.texture.setWrapU(SamplerState.WM_clamp)
+        self.texture.setWrapV(SamplerState.WM_clamp)
+
+    def card(self, path):
+        u0, v0, u1, v1 = self.uvs[path]
+        cm = CardMaker(Filename(path).getBasenameWoExtension())
+        cm.setFrame(-1, 1, -1, 1)
+        cm.setUvRange((u0, v0), (u1, v1))
+        card = NodePath(cm.generate())
+        card.setTexture(self.texture)
+        card.setTransparency(TransparencyAttrib.MAlpha)
+        return card
+
+
+class Hud:
+    def __init__(self, base):
+        self.atlas = base.hud_atlas
+        self.root = base.aspect2d.attachNewNode("hud")
+        # Static cards are batched into a layer behind and a layer in front
+        # of the dynamic widgets, which keep the default sort of 0.
+        self.layers = {
+            "back": self.root.attachNewNode("hud_back", -1),
+            "front": self.root.attachNewNode("hud_front", 1),
+        }
+        self.values = {}
+
+    def image(self, path, pos, scale, layer="front"):
+        card = self.atlas.card(path)
+        card.reparent_to(self.layers[layer] if layer else self.root)
+        card.set_pos(pos)
+        card.set_scale(scale)
+        return card
+
+    def update(self, name, value, apply):
+        if name in self.values and self.values[name] == value:
+            return
+        self.values[name] = value
+        apply(value)
+
+    def flatten(self):
+        for layer in self.layers.values():
+            layer.flattenStrong()
+
+    def destroy(self):
+        self.root.remove_node()
+
+
+class MarkerLayer:
+    def __init__(self, parent, texture, uv, size, positions):
+        self.size = size
+        self.uv = uv
+        self.positions = positions
+        self.node = parent.attachNewNode(GeomNode("markers"))
+        self.node.setTexture(texture)
+        self.node.setTransparency(TransparencyAttrib.MAlpha)
+        self.capacity = 0
+        self.reserve(16)
+
+    def reserve(self, capacity):
+        if capacity <= self.capacity:
+            return
+        self.capacity = capacity
+        vformat = GeomVertexFormat.getV3t2()
+        vdata = GeomVertexData("markers", vformat, Geom.UH_dynamic)
+        vdata.unclean_set_num_rows(capacity * 4)
+        self.vertices = np.zeros((capacity * 4, 5), dtype=np.float32)
+        u0, v0, u1, v1 = self.uv
+        self.vertices[:, 3:] = np.tile(
+            np.array([[u0, v0], [u1, v0], [u1, v1], [u0, v1]], dtype=np.float32),
+            (capacity, 1),
+        )
+        quads = np.arange(capacity, dtype=np.uint32)[:, None] * 4
+        self.indices = (quads + np.array([0, 1, 2, 0, 2, 3], dtype=np.uint32)).ravel()
+        self.tris = GeomTriangles(Geom.UH_dynamic)
+        self.tris.setIndexType(Geom.NT_uint32)
+        self.geom = Geom(vdata)
+        self.geom.addPrimitive(self.tris)
+        self.node.node().removeAllGeoms()
+        self.node.node().addGeom(self.geom)
+
+    def update(self, origin, centre, scale, radius):
+        points = np.asarray(self.positions(), dtype=np.float32).reshape(-1, 3)[:, :2]
+        offsets = points - np.array([origin.x, origin.y], dtype=np.float32)
+        visible = offsets[np.einsum("ij,ij->i", offsets, offsets) <= radius * radius]
+        screen = visible * scale + np.array([centre.x, centre.z], dtype=np.float32)
+        corners = np.array(
+            [[-1, -1], [1, -1], [1, 1], [-1, 1]], dtype=np.float32
+        ) * self.size
+        quads = np.zeros((len(visible), 4, 3), dtype=np.float32)
+        quads[:, :, 0::2] = screen[:, None, :] + corners[None, :, :]
+        self.upload(quads)
+
+    def upload(self, quads):
+        # quads holds four corners per marker, in u0v0 u1v0 u1v1 u0v1 order.
+        self.reserve(len(quads))
+        count = len(quads) * 4
+        self.vertices[:count, :3] = quads.reshape(-1, 3)
+        vdata = self.geom.modifyVertexData()
+        memoryview(vdata.modifyArray(0)).cast("B")[: count * 20] = self.vertices[
+            :count
+        ].tobytes()
+        indices = self.tris.modifyVertices()
+        indices.unclean_set_num_rows(len(quads) * 6)
+        if len(quads):
+            memoryview(indices).cast("B")[:] = self.indices[: len(quads) * 6].tobytes()
+        # Raw writes skip the bounds bookkeeping; re-setting the Geom makes
+        # the node recompute its cull bounds.
+        self.geom.markBoundsStale()
+        self.node.node().setGeom(0, self.geom)
+
+    def destroy(self):
+        self.node.remove_node()
+
+
+class ImpostorLayer(MarkerLayer):
+    # World-space cards that turn about Z to face the eye, all in one Geom.
+    # Their texture is a snapshot of the model they stand in for.
+    def __init__(self, base, parent, resolution=128):
+        self.base = base
+        self.resolution = resolution
+        self.texture = Texture("impostor")
+        self.buffer = None
+        super().__init__(parent, self.texture, (0, 0, 1, 1), 1, None)
+        self.node.setLightOff()
+        self.node.setTransparency(TransparencyAttrib.MBinary)
+        self.resize(1, 0, 1)
+
+    def resize(self, width, bottom, top):
+        self.size = width / 2
+        self.bottom = bottom
+        self.top = top
+
+    def capture(self, model, transform, lo, hi):
+        # Renders model, placed by transform, from its front into the texture.
+        # The buffer is one-shot, so it draws with the next frame and then
+        # goes inactive; the image is copied to RAM so it outlives the buffer.
+        props = FrameBufferProperties()
+        props.setRgbaBits(8, 8, 8, 8)
+        props.setDepthBits(16)
+        buffer = self.base.win.makeTextureBuffer(
+            "impostor", self.resolution, self.resolution, self.texture, True, props
+        )
+        if buffer is None:
+            return
+        buffer.setClearColor((0, 0, 0, 0))
+        buffer.setOneShot(True)
+        self.buffer = buffer
+
+        # Nothing in the scene points back at the camera or the lights, so
+        # all of it is freed along with the buffer.
+        scene = NodePath("impostor_scene")
+        holder = scene.attachNewNode("model")
+        holder.setTransform(transform)
+        model.instanceTo(holder)
+        ambient = AmbientLight("impostor_ambient")
+        ambient.setColor(Vec4(0.6, 0.6, 0.6, 1))
+        sun = DirectionalLight("impostor_sun")
+        sun.setDirection(Vec3(0, -10, -10))
+        scene.setLight(NodePath(ambient))
+        scene.setLight(NodePath(sun))
+
+        lens = OrthographicLens()
+        lens.setFilmSize(2 * self.size, hi.z - lo.z)
+        depth = hi.y - lo.y
+        lens.setNearFar(1, depth + 2)
+        camera = NodePath(Camera("impostor_camera", lens))
+        camera.node().setScene(scene)
+        camera.set_pos_hpr((lo.x + hi.x) / 2, hi.y + 1, (lo.z + hi.z) / 2, 180, 0, 0)
+        buffer.makeDisplayRegion().setCamera(camera)
+
+    def release_buffer(self):
+        if self.buffer is not None:
+            self.base.graphicsEngine.removeWindow(self.buffer)
+            self.buffer = None
+
+    def update(self, points, eye):
+        if self.buffer is not None and not self.buffer.isActive():
+            self.release_buffer()
+        to_eye = np.array([eye.x, eye.y], dtype=np.float32) - points[:, :2]
+        length = np.maximum(np.linalg.norm(to_eye, axis=1), 1e-6)
+        right = np.zeros((len(points), 3), dtype=np.float32)
+        right[:, 0] = -to_eye[:, 1] / length * self.size
+        right[:, 1] = to_eye[:, 0] / length * self.size
+        low = points + np.array([0, 0, self.bottom], dtype=np.float32)
+        high = points + np.array([0, 0, self.top], dtype=np.float32)
+        self.upload(np.stack([low - right, low + right, high + right, high - right], axis=1))
+
+    def destroy(self):
+        self.release_buffer()
+        super().destroy()
+
+
+class Minimap:
+    def __init__(self, base, hud, pos, focus, world_radius=50, interval=1 / 15):
+        self.base = base
+        self.hud = hud
+        self.pos = pos
+        self.focus = focus
+        self.world_radius = world_radius
+        self.radius = 0.25
+        self.hud.image(
+            "assets/textures/minimap.png", pos, (self.radius, 1, self.radius), "back"
+        )
+        self.root = hud.root.attachNewNode("minimap_markers")
+        self.layers = {}
+
+        self.player_image = hud.image(
+            "assets/textures/playerhead.png", pos, (0.015, 1, 0.015), None
+        )
+        self.interval = interval
+        self.job = None
+
+    def start(self):
+        self.job = self.base.scheduler.add(
+            "Minimap", self.update, priority=2, rate=1 / self.interval
+        )
+
+    def stop(self):
+        if self.job:
+            self.job.remove()
+            self.job = None
+
+    def add_category(self, name, texture_path, positions, size=0.02):
+        self.layers[name] = MarkerLayer(
+            self.root,
+            self.hud.atlas.texture,
+            self.hud.atlas.uvs[texture_path],
+            size,
+            positions,
+        )
+
+    def update(self):
+        origin = self.focus.get_pos()
+        scale = self.radius / self.world_radius
+        for layer in self.layers.values():
+            layer.update(origin, self.pos, scale, self.world_radius)
+
+    def destroy(self):
+        self.stop()
+        for layer in self.layers.values():
+            layer.destroy()
+
+
 class HealthBar(NodePath):
     def __init__(self):
         NodePath.__init__(self, "healthbar")
@@ -783,12 +3235,39 @@ class HealthBar(NodePath):
         self.fg.setColor(0, 1, 0, 1)
         self.bg.setColor(0.5, 0.5, 0.5, 1)
 
+        self.value = None
         self.setHealth(1)
 
     def setHealth(self, value):
+        if value == self.value:
+            return
+        self.value = value
         self.fg.setScale(value, 1, 1)
         self.bg.setScale(1.0 - value, 1, 1)
 
 
-app = App()
-app.run()
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Martian Madness")
+    parser.add_argument(
+        "--record-timings", metavar="CSV", help="stream per-frame system timings here"
+    )
+    parser.add_argument(
+        "--timing-overlay", action="store_true", help="show system timings (F3)"
+    )
+    parser.add_argument(
+        "--record",
+        metavar="FILE",
+        help="record input for replay; each level started after the first is "
+        "recorded to FILE-2, FILE-3, ...",
+    )
+    parser.add_argument("--replay", metavar="FILE", help="replay recorded input")
+    args = parser.parse_args()
+    app = App(
+        timings_path=args.record_timings,
+        timing_overlay=args.timing_overlay,
+        record_path=args.record,
+        replay_path=args.replay,
+    )
+    if app.replay:
+        app.fsm.request("Loading", {"Level1": Level1, "Level2": Level2}[app.replay.level])
+    app.run()
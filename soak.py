@@ -0,0 +1,215 @@
+import argparse
+import gc
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+from panda3d.core import (
+    ClockObject,
+    GeomCacheManager,
+    GeomVertexArrayData,
+    TexturePool,
+    loadPrcFileData,
+)
+
+from benchmark import SCENARIOS, ScriptedInput
+
+# Allowed growth per cycle before a metric counts as leaking. Scene graph
+# and engine counts must be flat; byte counts get some slack for text
+# geometry, the allocator and interned strings settling.
+TOLERANCES = {
+    "nodes": 0,
+    "colliders": 0,
+    "tasks": 0,
+    "event_hooks": 0,
+    "textures": 0,
+    "texture_bytes": 0,
+    "vertex_bytes": 4 * 1024,
+    "gsg_textures": 0,
+    "gsg_vertex_buffers": 0.5,
+    "rss_bytes": 256 * 1024,
+    "python_objects": 100,
+    "python_bytes": 64 * 1024,
+}
+
+
+def rss_bytes():
+    # Catches native leaks the engine counters above cannot see. Linux
+    # only; elsewhere this reads 0.
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return 0
+
+
+def sample(app):
+    from direct.showbase.MessengerGlobal import messenger
+
+    gc.collect()
+    roots = (app.render, app.render2d, app.hidden)
+    textures = set(TexturePool.findAllTextures())
+    for root in roots:
+        textures.update(root.findAllTextures())
+    traversers = [t for t in (app.cTrav, app.fsm.warm and app.fsm.warm.cTrav) if t]
+    gsg = app.win.getGsg() if app.win else None
+    prepared = gsg.getPreparedObjects() if gsg else None
+    return {
+        "nodes": sum(root.countNumDescendants() + 1 for root in roots),
+        "colliders": sum(t.getNumColliders() for t in traversers),
+        "tasks": len(app.taskMgr.getAllTasks()),
+        "event_hooks": sum(len(messenger.whoAccepts(e) or ()) for e in messenger.getEvents()),
+        "textures": len(textures),
+        "texture_bytes": sum(t.estimateTextureMemory() for t in textures),
+        "vertex_bytes": GeomVertexArrayData.getIndependentLru().getTotalSize()
+        + GeomVertexArrayData.getSmallLru().getTotalSize(),
+        "gsg_textures": prepared.getNumPreparedTextures() if prepared else 0,
+        "gsg_vertex_buffers": prepared.getNumPreparedVertexBuffers() if prepared else 0,
+        "rss_bytes": rss_bytes(),
+        "python_objects": len(gc.get_objects()),
+        "python_bytes": tracemalloc.get_traced_memory()[0],
+    }
+
+
+def slope(values):
+    # Median growth per cycle over every pair of samples, so one step in a
+    # noisy metric (the allocator taking a new arena) does not read as a leak.
+    rates = sorted(
+        (values[j] - values[i]) / (j - i)
+        for i in range(len(values))
+        for j in range(i + 1, len(values))
+    )
+    if not rates:
+        return 0.0
+    mid = len(rates) // 2
+    return rates[mid] if len(rates) % 2 else (rates[mid - 1] + rates[mid]) / 2
+
+
+def find_leaks(samples, tolerances):
+    leaks = {}
+    for name, tolerance in tolerances.items():
+        values = [s[name] for s in samples]
+        growth = slope(values)
+        if len(values) > 1 and growth > tolerance and values[-1] > values[0]:
+            leaks[name] = {"per_cycle": growth, "first": values[0], "last": values[-1]}
+    return leaks
+
+
+def run(args):
+    loadPrcFileData(
+        "",
+        f"window-type {args.window}\n"
+        "audio-library-name null\n"
+        "sync-video false\n"
+        "notify-level-device fatal\n",
+    )
+    tracemalloc.start(args.traceback)
+    import main
+
+    app = main.App()
+    clock = ClockObject.getGlobalClock()
+    clock.setMode(ClockObject.MNonRealTime)
+    clock.setFrameRate(60)
+    scripted = ScriptedInput(SCENARIOS[args.scenario])
+    app.mouseWatcherNode = scripted
+    fsm = app.fsm
+
+    def step(frames=1):
+        for _ in range(frames):
+            scripted.advance()
+            app.taskMgr.step()
+
+    def wait_for(state):
+        for _ in range(args.timeout_frames):
+            if fsm.state == state:
+                return
+            step()
+        raise RuntimeError(f"stuck in {fsm.state} waiting for {state}")
+
+    def play(level_class):
+        fsm.play(level_class)
+        wait_for(level_class.__name__)
+        step(args.frames)
+        return getattr(fsm, level_class.__name__.lower())
+
+    def die(level):
+        level.player.take_damage(level.player.hp)
+        wait_for("DeadScreen")
+        step()
+
+    samples = []
+    baseline = None
+    start = time.perf_counter()
+    for cycle in range(args.warmup + args.cycles):
+        # A fresh load and a warm restart of Level1, then Level2, which
+        # destroys the warm Level1 and is itself destroyed next cycle.
+        die(play(main.Level1))
+        die(play(main.Level1))
+        fsm.request("MainMenu")
+        play(main.Level2)
+        fsm.request("MainMenu")
+        # The Geom cache keeps animated copies of recently drawn vertices;
+        # drop it so the counts below only see live geometry.
+        GeomCacheManager.getGlobalPtr().flush()
+        step(2)
+        if cycle < args.warmup:
+            continue
+        if baseline is None:
+            # Taken before sampling, as the snapshot itself adds to the RSS.
+            baseline = tracemalloc.take_snapshot()
+        samples.append(sample(app))
+        print(f"cycle {len(samples)}: {samples[-1]}", file=sys.stderr)
+
+    growth = tracemalloc.take_snapshot().compare_to(baseline, "lineno")
+    fsm.request("MainMenu")
+    fsm.drop_warm()
+    app.destroy()
+    leaks = find_leaks(samples, TOLERANCES)
+    return {
+        "cycles": args.cycles,
+        "warmup": args.warmup,
+        "frames": args.frames,
+        "seconds": time.perf_counter() - start,
+        "samples": samples,
+        "slopes": {name: slope([s[name] for s in samples]) for name in TOLERANCES},
+        "leaks": leaks,
+        "top_growth": [str(stat) for stat in growth[: args.top]],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Cycle Martian Madness through its states and check for leaks."
+    )
+    parser.add_argument("--cycles", type=int, default=10)
+    parser.add_argument("--warmup", type=int, default=2, help="cycles before sampling")
+    parser.add_argument("--frames", type=int, default=120, help="frames played per level")
+    parser.add_argument("--scenario", default="patrol", choices=sorted(SCENARIOS))
+    parser.add_argument("--window", default="offscreen", choices=["offscreen", "none"])
+    parser.add_argument("--timeout-frames", type=int, default=2000)
+    parser.add_argument("--traceback", type=int, default=1, help="tracemalloc frames")
+    parser.add_argument("--top", type=int, default=10, help="allocation sites to report")
+    parser.add_argument("--output", help="write the JSON report here")
+    args = parser.parse_args()
+
+    report = run(args)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+    else:
+        print(text)
+    for name, leak in report["leaks"].items():
+        print(
+            f"leak: {name} grew {leak['per_cycle']:.1f}/cycle "
+            f"({leak['first']} -> {leak['last']})",
+            file=sys.stderr,
+        )
+    if report["leaks"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()